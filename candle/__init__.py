@@ -1,5 +1,7 @@
 from .context import *
+from .cost import *
 from .debug import *
+from .distributed import *
 from .estimator import *
 from .model import *
 from .nested import *
@@ -10,5 +12,5 @@ from .quantize import *
 from .regularize import *
 from .visualize import *
 
-__all__ = ["context", "debug", "estimator", "model", "nested", "optim", "proxy", "prune", "quantize", 
+__all__ = ["context", "cost", "debug", "distributed", "estimator", "model", "nested", "optim", "proxy", "prune", "quantize", 
     "regularize", "visualize"]
\ No newline at end of file
@@ -1,10 +1,16 @@
 import argparse
+import collections
+import fnmatch
 import itertools
+import math
 
 import torch
 import torch.nn as nn
 
+from . import distributed
 from .debug import *
+from .nested import Package
+from .optim import FlatParameterBucket
 from .proxy import *
 
 def read_cli_config():
@@ -43,39 +49,108 @@ class ProxyRegistry(object):
         return list(filter(lambda x: isinstance(x, proxy_class), proxies))
 
 class Memoizer(object):
-    def __init__(self):
-        self.cache = {}
+    """
+    LRU cache for values computed on demand. max_size bounds the number of entries and
+    max_bytes the total size of cached tensors; entries can be tagged and invalidated per tag.
+    Copies start empty, as cached values are derived from state held elsewhere.
+    """
+
+    def __init__(self, max_size=None, max_bytes=None):
+        self.cache = collections.OrderedDict()
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._sizes = {}
+        self._tags = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self.cache),
+            nbytes=self.nbytes, hit_rate=self.hits / lookups if lookups else 0)
 
     def wrap(self, function, *args, **kwargs):
         return lambda: function(*args, **kwargs)
 
+    def __deepcopy__(self, memo):
+        return Memoizer(self.max_size, self.max_bytes)
+
     def delete(self, name):
         try:
             del self.cache[name]
-        except:
-            pass
+        except KeyError:
+            return
+        self.nbytes -= self._sizes.pop(name, 0)
+        for keys in self._tags.values():
+            keys.discard(name)
+
+    def invalidate(self, tag):
+        for key in list(self._tags.pop(tag, ())):
+            self.delete(key)
 
-    def __call__(self, key, not_present_fn, refresh=False):
-        if refresh or key not in self.cache:
-            self.cache[key] = not_present_fn()
-        return self.cache[key]
+    def clear(self):
+        self.cache.clear()
+        self._sizes.clear()
+        self._tags.clear()
+        self.nbytes = 0
+
+    def _evict(self):
+        while self.cache and ((self.max_size is not None and len(self.cache) > self.max_size) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key = next(iter(self.cache))
+            self.delete(key)
+            self.evictions += 1
+
+    def __call__(self, key, not_present_fn, refresh=False, tag=None):
+        if not refresh and key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        self.delete(key)
+        value = not_present_fn()
+        self.cache[key] = value
+        self._sizes[key] = _nbytes(value)
+        self.nbytes += self._sizes[key]
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+        self._evict()
+        return value
+
+def _nbytes(value):
+    if isinstance(value, Package):
+        value = value.reify(flat=True)
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    return 0
 
 class Context(object):
-    def __init__(self, config=None, **kwargs):
+    supported_types = (nn.modules.conv._ConvNd, nn.Linear, nn.modules.rnn.RNNBase)
+
+    def __init__(self, config=None, cache_max_size=None, cache_max_bytes=None, **kwargs):
         self._cfg_kwargs = vars(config) if config else {}
         self._cfg_kwargs.update(kwargs)
         self.registry = ProxyRegistry()
         self.layers = []
         self.torch_modules = []
         self.opt_params = []
-        self.cache = Memoizer()
+        self.cache = Memoizer(max_size=cache_max_size, max_bytes=cache_max_bytes)
+        self.flat_buckets = []
 
     def build_provider(self, layer):
         return IdentityProxy(layer, layer.parameters())
 
     def list_proxies(self, proxy_type=None, proxy_class=None):
         return self.cache("proxies.{}.{}".format(proxy_type, proxy_class),
-            lambda: self.registry.find_all(proxy_type, proxy_class))
+            lambda: self.registry.find_all(proxy_type, proxy_class), tag="proxies")
 
     def list_providers(self):
         return self.list_proxies("weight_provider")
@@ -97,6 +172,62 @@ class Context(object):
             lst.extend(self.opt_params)
         return lst
 
+    def list_param_groups(self, filter_fn=None, include_opt=True, weight_decay=None, resolution=4, flat=False):
+        """
+        Like list_params, but merges proxies whose options match into one group. lr_scale is
+        rounded to 1 / resolution of an octave (None keeps exact scales). If weight_decay is given,
+        params with more than one dimension get it and the rest get none. flat=True stores each
+        group in one contiguous FlatParameterBucket; see Context.zero_grad.
+        """
+        buckets = collections.OrderedDict()
+        seen = set()
+        for group in self.list_params(filter_fn, include_opt=False):
+            options = {k: v for k, v in group.items() if k != "params"}
+            if "lr_scale" in options and resolution is not None:
+                options["lr_scale"] = 2**(round(math.log2(options["lr_scale"]) * resolution) / resolution)
+            for param in group["params"]:
+                if id(param) in seen:
+                    continue
+                seen.add(id(param))
+                param_options = dict(options)
+                if weight_decay is not None:
+                    param_options["weight_decay"] = weight_decay if param.dim() > 1 else 0
+                buckets.setdefault(tuple(sorted(param_options.items())), []).append(param)
+
+        groups = []
+        for options, params in buckets.items():
+            if flat:
+                bucket = FlatParameterBucket(params)
+                self.flat_buckets.append(bucket)
+                params = [bucket.flat]
+            groups.append(dict(params=params, **dict(options)))
+        if include_opt:
+            groups.extend(self.opt_params)
+        return groups
+
+    def zero_grad(self):
+        for bucket in self.flat_buckets:
+            bucket.zero_grad()
+
+    def list_flat_params(self, filter_fn=None, include_opt=True):
+        params = []
+        for group in self.list_params(filter_fn, include_opt):
+            params.extend(group["params"] if isinstance(group, dict) else [group])
+        return distributed.unique_tensors(params)
+
+    def list_module_buffers(self):
+        modules = self.layers + self.torch_modules
+        return distributed.unique_tensors(itertools.chain.from_iterable(m.buffers() for m in modules))
+
+    def all_reduce_gradients(self, bucket_bytes=25 * 2**20, average=True, group=None):
+        distributed.all_reduce_gradients(self.list_flat_params(), bucket_bytes, average=average, group=group)
+
+    def broadcast_parameters(self, src=0, group=None):
+        distributed.broadcast_tensors(self.list_flat_params() + self.list_module_buffers(), src, group=group)
+
+    def broadcast_buffers(self, src=0, group=None):
+        distributed.broadcast_tensors(self.list_module_buffers(), src, group=group)
+
     def list_buffers(self, filter_fn=None):
         all_proxies = self.list_proxies()
         if filter_fn is None:
@@ -116,6 +247,7 @@ class Context(object):
             kwargs["stride"] = stride
             kwargs["padding"] = padding
             kwargs["dilation"] = dilation
+            kwargs["groups"] = layer.groups
             if isinstance(layer, nn.Conv3d):
                 return ProxyConv3d(provider, **kwargs)
             elif isinstance(layer, nn.Conv2d):
@@ -142,8 +274,43 @@ class Context(object):
         cfg.update(kwargs)
         wrapped_layer = self.compose(layer, **cfg)
         self.layers.append(wrapped_layer) # TODO: insert per-layer hyperparams (mask decay, etc) here if needed
+        self.cache.invalidate("proxies")
         return wrapped_layer
 
+    def supports(self, layer):
+        return isinstance(layer, self.supported_types) and not isinstance(layer, ProxyLayer)
+
+    def _match(self, patterns, name, layer):
+        for pattern in patterns:
+            if isinstance(pattern, str) and fnmatch.fnmatchcase(name, pattern):
+                return True
+            if isinstance(pattern, type) and isinstance(layer, pattern):
+                return True
+        return False
+
+    def wrap_model(self, module, include=None, exclude=(), **kwargs):
+        """
+        Replaces every supported layer in module with its proxy, in place. include and exclude
+        are sequences of layer types or fnmatch patterns over qualified module names. Proxies and
+        their hook parameters are built right away, so module.parameters() and state_dict keys are
+        final before the first forward.
+        """
+        def visit(parent, prefix):
+            for child_name, child in list(parent._modules.items()):
+                if child is None or isinstance(child, ProxyLayer):
+                    continue
+                name = prefix + child_name
+                if not self.supports(child):
+                    visit(child, name + ".")
+                    continue
+                if include is not None and not self._match(include, name, child):
+                    continue
+                if self._match(exclude, name, child):
+                    continue
+                setattr(parent, child_name, self.wrap(child, **kwargs))
+        visit(module, "")
+        return module
+
     def debug(self, layer, hook_types, type, **kwargs):
         debug_layer(layer, hook_types, type, **kwargs)
         return layer
@@ -151,6 +318,7 @@ class Context(object):
     def bypass(self, layer):
         self.registry.register_proxy("fake", FakeProxy(layer, layer.parameters()))
         self.torch_modules.append(layer)
+        self.cache.invalidate("proxies")
         return layer
 
     def disable_hooks(self):
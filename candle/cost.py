@@ -0,0 +1,251 @@
+import time
+
+import torch
+import torch.nn as nn
+
+from .proxy import *
+from .proxy import _ProxyConvNd
+from .quantize import *
+
+def _weight_bits(layer):
+    """Effective weight bit-width of a module, read from the quantization hooks on its provider chain."""
+    proxy = getattr(layer, "weight_provider", None)
+    while isinstance(proxy, ProxyDecorator):
+        if isinstance(proxy, QuantizeHook):
+            return proxy.args[0]
+        if isinstance(proxy, DoReFaWeightHook):
+            return proxy.k
+        if isinstance(proxy, TernaryWeightHook):
+            return 2
+        if isinstance(proxy, (StepQuantizeHook, StochasticQuantizeHook)):
+            return 1
+        proxy = proxy.child
+    return 32
+
+def _activation_bits(module):
+    if isinstance(module, LinearQuantActivation):
+        return module.args[0]
+    if isinstance(module, DoReFaActivation):
+        return module.k
+    if isinstance(module, TernaryActivation):
+        return 2
+    if isinstance(module, (BinaryActivation, StochasticActivation)):
+        return 1
+    return None
+
+def _layer_weights(layer):
+    if isinstance(layer, ProxyLayer):
+        return layer.weight_provider().reify(flat=True)
+    if isinstance(layer, nn.modules.rnn.RNNBase):
+        return [w for weights in layer.all_weights for w in weights]
+    return [p for p in (layer.weight, layer.bias) if p is not None]
+
+def _nonzero(tensor):
+    return int((tensor.data != 0).long().sum())
+
+def _tensors(values):
+    if isinstance(values, torch.Tensor):
+        return [values]
+    if isinstance(values, nn.utils.rnn.PackedSequence):
+        return [values.data]
+    if isinstance(values, (list, tuple)):
+        return [t for v in values for t in _tensors(v)]
+    return []
+
+class LayerCost(object):
+    def __init__(self, name, layer):
+        self.name = name
+        self.type = type(layer).__name__
+        self.layer = layer
+        self.macs = 0
+        self.dense_macs = 0
+        self.params = 0
+        self.dense_params = 0
+        self.bits = _weight_bits(layer)
+        self.input_bits = 32
+        self.activation_bytes = 0
+        self.calls = 0
+        self.latency = None
+
+    @property
+    def weight_bytes(self):
+        return self.params * self.bits / 8
+
+    @property
+    def memory_bytes(self):
+        return self.weight_bytes + self.activation_bytes
+
+    @property
+    def density(self):
+        return self.macs / max(self.dense_macs, 1)
+
+class CostModel(object):
+    """
+    Per-layer cost of a (possibly Context-wrapped) model, traced on a sample input. MACs and
+    parameters count only nonzero weights after all hooks, so masks are accounted for; bits come
+    from quantization hooks and preceding activation quantizers. All counts are per sample.
+    """
+
+    def __init__(self, model, latency_table=None):
+        self.model = model
+        self.latency_table = {} if latency_table is None else dict(latency_table)
+        self.layers = []
+        self._inputs = {}
+
+    def _costed_modules(self):
+        modules = []
+        nested = set()
+        for name, module in self.model.named_modules():
+            if id(module) in nested:
+                continue
+            if isinstance(module, ProxyLayer):
+                nested.update(id(m) for m in module.modules() if m is not module)
+            elif not isinstance(module, (nn.Linear, nn.modules.conv._ConvNd, nn.modules.rnn.RNNBase)):
+                continue
+            modules.append((name, module))
+        return modules
+
+    def _count(self, entry, layer, inputs, output):
+        x = _tensors(inputs)[0]
+        out = _tensors(output)[0]
+        weights = _layer_weights(layer)
+        matrices = [w for w in weights if w.dim() > 1]
+        nnz = sum(_nonzero(w) for w in matrices)
+        numel = sum(w.numel() for w in matrices)
+        if isinstance(layer, (nn.modules.rnn.RNNBase, ProxyRNN)):
+            # every weight matrix is applied once per time step of every sequence
+            if isinstance(inputs[0], nn.utils.rnn.PackedSequence):
+                positions = x.size(0)
+            else:
+                positions = x.size(0) * x.size(1)
+        elif isinstance(layer, nn.modules.conv._ConvNd) and layer.transposed:
+            positions = x.numel() // x.size(1)
+        elif isinstance(layer, (nn.modules.conv._ConvNd, _ProxyConvNd)):
+            positions = out.numel() // out.size(1)
+        else:
+            positions = out.numel() // out.size(-1)
+        entry.macs += positions * nnz
+        entry.dense_macs += positions * numel
+        entry.params = sum(_nonzero(w) for w in weights)
+        entry.dense_params = sum(w.numel() for w in weights)
+        entry.activation_bytes += x.numel() * entry.input_bits / 8 + out.numel() * 4
+        entry.calls += 1
+
+    def trace(self, *inputs, batch_size=None, keep_inputs=True):
+        """
+        Runs the model once on inputs and records the cost of every weighted layer. The batch size
+        defaults to the first dimension of the first input; pass it for sequence-first inputs.
+        """
+        self.layers = []
+        self._inputs = {}
+        quantized = {}
+        handles = []
+        def record_bits(bits):
+            def hook(module, args, output):
+                quantized[id(output)] = bits
+            return hook
+        def record_cost(entry):
+            def pre_hook(module, args):
+                x = _tensors(args)
+                entry.input_bits = quantized.get(id(x[0]), 32) if x else 32
+            def hook(module, args, output):
+                self._count(entry, module, args, output)
+                if keep_inputs and entry.name not in self._inputs:
+                    self._inputs[entry.name] = args
+            return pre_hook, hook
+        for module in self.model.modules():
+            bits = _activation_bits(module)
+            if bits is not None:
+                handles.append(module.register_forward_hook(record_bits(bits)))
+        for name, module in self._costed_modules():
+            entry = LayerCost(name, module)
+            self.layers.append(entry)
+            pre_hook, hook = record_cost(entry)
+            handles.append(module.register_forward_pre_hook(pre_hook))
+            handles.append(module.register_forward_hook(hook))
+        training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                self.model(*inputs)
+        finally:
+            self.model.train(training)
+            for handle in handles:
+                handle.remove()
+        if batch_size is None:
+            x = _tensors(inputs)
+            batch_size = x[0].size(0) if x and x[0].dim() > 1 else 1
+        self.batch_size = batch_size
+        for entry in self.layers:
+            entry.macs /= batch_size
+            entry.dense_macs /= batch_size
+            entry.activation_bytes /= batch_size
+        self.layers = [entry for entry in self.layers if entry.calls > 0]
+        return self.layers
+
+    def calibrate(self, repeats=10, warmup=2):
+        """
+        Times every traced layer on its recorded input and fills latency_table with seconds per MAC
+        for each layer type, so latency() can predict the cost of other pruned or quantized variants.
+        """
+        totals = {}
+        training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                for entry in self.layers:
+                    args = self._inputs.get(entry.name)
+                    if args is None:
+                        continue
+                    for _ in range(warmup):
+                        entry.layer(*args)
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        entry.layer(*args)
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    entry.latency = (time.perf_counter() - start) / repeats / self.batch_size
+                    seconds, macs = totals.get(entry.type, (0, 0))
+                    totals[entry.type] = (seconds + entry.latency, macs + entry.macs)
+        finally:
+            self.model.train(training)
+        for layer_type, (seconds, macs) in totals.items():
+            self.latency_table[layer_type] = seconds / max(macs, 1)
+        return self.latency_table
+
+    def predicted_latency(self, entry):
+        if entry.type not in self.latency_table:
+            return None
+        return entry.macs * self.latency_table[entry.type]
+
+    def latency(self):
+        latencies = [self.predicted_latency(entry) for entry in self.layers]
+        return sum(l for l in latencies if l is not None)
+
+    @property
+    def macs(self):
+        return sum(entry.macs for entry in self.layers)
+
+    @property
+    def params(self):
+        return sum(entry.params for entry in self.layers)
+
+    @property
+    def memory_bytes(self):
+        return sum(entry.memory_bytes for entry in self.layers)
+
+    def summary(self):
+        lines = ["{:<24} {:>12} {:>10} {:>8} {:>5} {:>12}".format("layer", "MACs", "params", "density",
+            "bits", "bytes")]
+        for entry in self.layers:
+            lines.append("{:<24} {:>12.0f} {:>10} {:>8.3f} {:>5} {:>12.0f}".format(entry.name, entry.macs,
+                entry.params, entry.density, entry.bits, entry.memory_bytes))
+        lines.append("{:<24} {:>12.0f} {:>10}".format("total", self.macs, self.params))
+        return "\n".join(lines)
+
+def count_macs(model, *inputs):
+    cost = CostModel(model)
+    cost.trace(*inputs, keep_inputs=False)
+    return cost.macs
@@ -0,0 +1,76 @@
+import random
+
+import torch
+import torch.distributed as dist
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def init_distributed(rank, world_size, init_method="tcp://127.0.0.1:23456", backend="gloo"):
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+
+def _bucketize(tensors, bucket_bytes):
+    buckets = []
+    open_buckets = {}
+    for tensor in tensors:
+        key = (tensor.type(), tensor.device)
+        if key not in open_buckets:
+            open_buckets[key] = [[], 0]
+            buckets.append(open_buckets[key][0])
+        bucket = open_buckets[key]
+        bucket[0].append(tensor)
+        bucket[1] += tensor.numel() * tensor.element_size()
+        if bucket[1] >= bucket_bytes:
+            del open_buckets[key]
+    return buckets
+
+def _flat_op(tensors, op, bucket_bytes):
+    for bucket in _bucketize(tensors, bucket_bytes):
+        flat = torch.cat([t.contiguous().view(-1) for t in bucket])
+        op(flat)
+        offset = 0
+        for t in bucket:
+            t.copy_(flat[offset:offset + t.numel()].view_as(t))
+            offset += t.numel()
+
+def all_reduce_gradients(params, bucket_bytes=25 * 2**20, average=True, group=None):
+    """
+    All-reduces gradients of params in flattened buckets of at most bucket_bytes. Parameters
+    without a gradient get a zero gradient so every rank reduces the same buckets.
+    """
+    group = dist.group.WORLD if group is None else group
+    world_size = dist.get_world_size(group)
+    grads = []
+    for param in params:
+        if not param.requires_grad:
+            continue
+        if param.grad is None:
+            param.grad = param.data.new(param.size()).zero_()
+        grads.append(param.grad.data)
+    def reduce(flat):
+        dist.all_reduce(flat, group=group)
+        if average:
+            flat.div_(world_size)
+    _flat_op(grads, reduce, bucket_bytes)
+
+def broadcast_tensors(tensors, src=0, bucket_bytes=25 * 2**20, group=None):
+    group = dist.group.WORLD if group is None else group
+    _flat_op([t.data for t in tensors], lambda flat: dist.broadcast(flat, src, group=group), bucket_bytes)
+
+def broadcast_seed(seed=None, src=0, group=None):
+    group = dist.group.WORLD if group is None else group
+    if seed is None:
+        seed = random.randint(0, 2**31 - 1)
+    seed = torch.LongTensor([seed])
+    dist.broadcast(seed, src, group=group)
+    return int(seed[0])
+
+def unique_tensors(tensors):
+    seen = set()
+    unique = []
+    for tensor in tensors:
+        if id(tensor) in seen:
+            continue
+        seen.add(id(tensor))
+        unique.append(tensor)
+    return unique
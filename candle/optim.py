@@ -1,6 +1,57 @@
 import math
 
 import torch
+import torch.nn as nn
+
+class FlatParameterBucket(object):
+    """
+    Re-homes params as views into one contiguous parameter (and their grads as views into one
+    contiguous gradient), so optimizers step over a single tensor. Flatten after moving the model
+    to its device. Gradients cleared with set_to_none (by the optimizer or the model) are re-bound
+    as zeroed views on the next backward; zero_grad() zeroes the shared buffer directly.
+    """
+
+    def __init__(self, params):
+        self.params = list(params)
+        self.flat = nn.Parameter(torch.cat([p.data.contiguous().view(-1) for p in self.params]))
+        self.grad = self.flat.data.new(self.flat.size()).zero_()
+        self.offsets = []
+        offset = 0
+        for p in self.params:
+            self.offsets.append(offset)
+            p.data = self.flat.data[offset:offset + p.numel()].view_as(p.data)
+            p.grad = self._grad_view(p, offset)
+            p.register_hook(self._hook(p))
+            offset += p.numel()
+        self.flat.grad = self.grad
+
+    def _grad_view(self, p, offset):
+        return self.grad[offset:offset + p.numel()].view_as(p.data)
+
+    def _hook(self, p):
+        def hook(grad):
+            if self.flat.grad is not self.grad or p.grad is None:
+                self.rebind()
+        return hook
+
+    def rebind(self):
+        """Restores every grad as a view into the shared buffer, zeroing those that were set to None."""
+        if self.flat.grad is not self.grad:
+            self.grad.zero_()
+            self.flat.grad = self.grad
+        for p, offset in zip(self.params, self.offsets):
+            view = self._grad_view(p, offset)
+            if p.grad is None:
+                view.zero_()
+            elif p.grad.data_ptr() != view.data_ptr():
+                view.copy_(p.grad.data)
+            else:
+                continue
+            p.grad = view
+
+    def zero_grad(self):
+        self.grad.zero_()
+        self.rebind()
 
 # Adapted from pytorch repo
 class SGD(torch.optim.Optimizer):
@@ -50,6 +50,13 @@ class Proxy(object):
     def print_info(self):
         pass
 
+    def compact(self):
+        """
+        Optionally returns (weights, indices, dim): the weights restricted to the active output (dim 0)
+        or input (dim 1) channels given by indices, letting layers skip the inactive ones entirely.
+        """
+        return None
+
     @property
     def sizes(self):
         raise NotImplementedError
@@ -135,6 +142,7 @@ class ProxyLayer(nn.Module):
         self.output_proxy = None
         self.input_proxy = None
         self.registry = registry
+        self._param_options = None
 
         self._param_idx = 0
         self._register_all_params("weight_provider", weight_provider)
@@ -154,13 +162,12 @@ class ProxyLayer(nn.Module):
             self.register_parameter("proxy.{}".format(self._param_idx + i), parameter)
         self._param_idx += i + 1
         for name, buf in proxy.buffers():
-            print(name)
             self.register_buffer(name, buf)
 
     def _find_provider(self, provider_type, provider):
         if isinstance(provider, provider_type):
             return provider
-        if isinstance(provider, Proxy):
+        if not isinstance(provider, ProxyDecorator):
             return None
         return self._find_provider(provider_type, provider.child)
 
@@ -205,7 +212,12 @@ class ProxyLayer(nn.Module):
 
     @property
     def param_options(self):
-        return dict(lr_scale=self.lr_scale)
+        if self._param_options is None:
+            self._param_options = dict(lr_scale=float(self.lr_scale))
+        return self._param_options
+
+    def reset_param_options(self):
+        self._param_options = None
 
     @property
     def lr_scale(self):
@@ -215,7 +227,7 @@ class ProxyLayer(nn.Module):
         raise NotImplementedError
 
 class _ProxyConvNd(ProxyLayer):
-    def __init__(self, weight_provider, conv_fn, stride=1, padding=0, dilation=1, **kwargs):
+    def __init__(self, weight_provider, conv_fn, stride=1, padding=0, dilation=1, groups=1, **kwargs):
         super().__init__(weight_provider, **kwargs)
         sizes = weight_provider.sizes.reify()
         self._sizes = sizes
@@ -224,8 +236,9 @@ class _ProxyConvNd(ProxyLayer):
         self.stride = stride
         self.padding = padding
         self.dilation = dilation
+        self.groups = groups
         self.conv_fn = conv_fn
-        self._conv_kwargs = dict(dilation=dilation, padding=padding, stride=stride)
+        self._conv_kwargs = dict(dilation=dilation, padding=padding, stride=stride, groups=groups)
         if not self.bias:
             self._conv_kwargs["bias"] = None
 
@@ -238,9 +251,19 @@ class _ProxyConvNd(ProxyLayer):
         return scale
 
     def on_forward(self, x):
+        compact = self.weight_provider.compact()
+        if compact is not None:
+            return self._compact_forward(x, *compact)
         weights = self.weight_provider().reify()
         return self.conv_fn(x, *weights, **self._conv_kwargs)
 
+    def _compact_forward(self, x, weights, indices, dim):
+        if dim == 1:
+            return self.conv_fn(x.index_select(1, indices), *weights, **self._conv_kwargs)
+        out = self.conv_fn(x, *weights, **self._conv_kwargs)
+        full = out.new(out.size(0), self._sizes[0][0], *out.size()[2:]).zero_()
+        return full.index_copy(1, indices, out)
+
 class ProxyConv3d(_ProxyConvNd):
     def __init__(self, weight_provider, **kwargs):
         super().__init__(weight_provider, F.conv3d, **kwargs)
@@ -278,9 +301,19 @@ class ProxyLinear(ProxyLayer):
         root.package = Package(root._flattened_params)
 
     def on_forward(self, x):
+        compact = self.weight_provider.compact()
+        if compact is not None:
+            return self._compact_forward(x, *compact)
         weights = self.weight_provider().reify()
         return F.linear(x, *weights)
 
+    def _compact_forward(self, x, weights, indices, dim):
+        if dim == 1:
+            return F.linear(x.index_select(x.dim() - 1, indices), *weights)
+        out = F.linear(x, *weights)
+        full = out.new(*out.size()[:-1], self._sizes[0][0]).zero_()
+        return full.index_copy(out.dim() - 1, indices, out)
+
 class ProxyRNNBase(nn.modules.rnn.RNNBase):
     def __init__(self, mode, input_size, hidden_size,
                  num_layers=1, bias=True, batch_first=False,
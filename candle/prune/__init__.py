@@ -1,3 +1,7 @@
+from .budget import *
 from .channel import *
 from .dynamic import *
-from .prune import *
\ No newline at end of file
+from .export import *
+from .prune import *
+from .schedule import *
+from .sensitivity import *
\ No newline at end of file
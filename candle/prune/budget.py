@@ -0,0 +1,96 @@
+import json
+import os
+import time
+
+import torch
+
+from .export import export_slimmable
+
+class LatencyBudgetController(object):
+    """
+    Anytime inference for models trained with tied LinearMarkovDropout. Each width in widths is exported
+    once as a genuinely narrower model and profiled on sample_input; the latency table is cached in
+    table_path (JSON) when given. Each call runs the widest width whose predicted latency, scaled
+    linearly with batch size, fits the budget in seconds, and falls back to the narrowest width.
+    Widths are fractions in (0, 1] as given to UniformTiedGenerator.fix. Widths that cannot be exported
+    run the full model with tied_generator fixed at that width, restoring its state afterwards.
+    """
+
+    def __init__(self, model, sample_input, widths=(0.25, 0.5, 0.75, 1.0), budget=None, table_path=None,
+            tied_generator=None, repeats=10, specs=None):
+        self.model = model
+        if any(not 0 < width <= 1 for width in widths):
+            raise ValueError("Widths must be fractions in (0, 1]!")
+        self.widths = sorted(float(width) for width in widths)
+        self.budget = budget
+        self.tied_generator = tied_generator
+        self.models = {}
+        for width in self.widths:
+            try:
+                self.models[width] = export_slimmable(model, width, specs=specs)
+            except ValueError:
+                if tied_generator is None:
+                    raise
+        self.table = None
+        if table_path is not None and os.path.exists(table_path):
+            self.load(table_path)
+        if self.table is None or any(width not in self.table for width in self.widths):
+            self.profile(sample_input, repeats=repeats)
+            if table_path is not None:
+                self.save(table_path)
+
+    def run(self, width, x):
+        with torch.no_grad():
+            if width in self.models:
+                return self.models[width](x)
+            fixed, t = self.tied_generator.fixed, self.tied_generator.t
+            training = self.model.training
+            self.tied_generator.fix(width)
+            self.model.eval()
+            try:
+                return self.model(x)
+            finally:
+                self.model.train(training)
+                self.tied_generator.fixed, self.tied_generator.t = fixed, t
+
+    def profile(self, sample_input, repeats=10, warmup=2):
+        self.batch_size = sample_input.size(0)
+        self.table = {}
+        for width in self.widths:
+            for _ in range(warmup):
+                self.run(width, sample_input)
+            if sample_input.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                self.run(width, sample_input)
+            if sample_input.is_cuda:
+                torch.cuda.synchronize()
+            self.table[width] = (time.perf_counter() - start) / repeats
+        return self.table
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(dict(batch_size=self.batch_size, latency={str(w): t for w, t in self.table.items()}), f)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        self.batch_size = data["batch_size"]
+        self.table = {float(w): t for w, t in data["latency"].items()}
+
+    def predict(self, width, batch_size=None):
+        batch_size = self.batch_size if batch_size is None else batch_size
+        return self.table[width] * batch_size / self.batch_size
+
+    def select(self, budget=None, batch_size=None):
+        budget = self.budget if budget is None else budget
+        if budget is None:
+            return self.widths[-1]
+        fitting = [w for w in self.widths if self.predict(w, batch_size) <= budget]
+        return fitting[-1] if fitting else self.widths[0]
+
+    def __call__(self, x, budget=None):
+        width = self.select(budget, x.size(0))
+        self.last_width = width
+        return self.run(width, x)
@@ -27,91 +27,69 @@ class ChannelDropout(nn.Module):
         x = (x * mask.expand_as(x)) / (1 - self.drop_prob)
         return x
 
+def _zero_channels(module, indices):
+    module.weight.data.index_fill_(0, indices, 0)
+    if module.bias is not None:
+        module.bias.data.index_fill_(0, indices, 0)
+
+def _channel_scores(module, p):
+    norms = module.weight.data.view(module.weight.size(0), -1).norm(p=p, dim=1)
+    return norms / norms.sum()
+
 def linear_prune_qrnn(linear, percentage=None, fixed_size=None, mode="out"):
-    linear.pruned_indices = []
+    linear.pruned_indices = torch.LongTensor()
     Z_w, F_w, O_w = linear.module.weight_raw.data.chunk(3, dim=0)
     Z_b, F_b, O_b = linear.module.bias.data.chunk(3, dim=0)
     if mode == "out":
         if percentage is not None:
             fixed_size = int(percentage * Z_w.size(0))
-        Z_w = Z_w[:fixed_size, :]
-        F_w = F_w[:fixed_size, :]
-        O_w = O_w[:fixed_size, :]
-        Z_b = Z_b[:fixed_size]
-        F_b = F_b[:fixed_size]
-        O_b = O_b[:fixed_size]
-        linear.module.weight_raw.data = torch.cat([Z_w, F_w, O_w], 0)
-        linear.module.bias.data = torch.cat([Z_b, F_b, O_b], 0)
+        linear.module.weight_raw.data = torch.cat([Z_w[:fixed_size], F_w[:fixed_size], O_w[:fixed_size]], 0)
+        linear.module.bias.data = torch.cat([Z_b[:fixed_size], F_b[:fixed_size], O_b[:fixed_size]], 0)
     elif mode == "in":
         if percentage is not None:
             fixed_size = int(percentage * Z_w.size(1))
-        Z_w = Z_w[:, :fixed_size]
-        F_w = F_w[:, :fixed_size]
-        O_w = O_w[:, :fixed_size]
-        linear.module.weight_raw.data = torch.cat([Z_w, F_w, O_w], 0)
+        linear.module.weight_raw.data = torch.cat([Z_w[:, :fixed_size], F_w[:, :fixed_size], O_w[:, :fixed_size]], 0)
 
     return fixed_size
 
 def prune_qrnn(linear, percentage, p=1):
-    linear.pruned_indices = []
-    Z_w, F_w, O_w = linear.module.weight_raw.chunk(3, dim=0)
-    Z_b, F_b, O_b = linear.module.bias.chunk(3, dim=0)
-    Z_n, F_n, O_n = linear.module.weight_raw.norm(p=p, dim=1).chunk(3, dim=0)
-    Z_max, F_max, O_max = Z_n.max(), F_n.max(), O_n.max()
-    Z_n, F_n, O_n = Z_n / Z_max, F_n / F_max, O_n / O_max
-    scores = Z_n + F_n + O_n
-    local_scores = []
-    for idx in range(scores.size(0)):
-        local_scores.append((scores[idx].item(), idx))
-    
-    indices = []
-    local_scores.sort(key=lambda x: x[0])
-    for _, idx in local_scores[:int(percentage * len(local_scores[:-1]))]:
-        indices.append(idx)
-        idx1 = idx
-        idx2 = idx + scores.size(0)
-        idx3 = idx + scores.size(0) * 2
-        linear.module.weight_raw.data[idx1, ...] = 0
-        linear.module.bias.data[idx1] = 0
-        linear.module.weight_raw.data[idx2, ...] = 0
-        linear.module.bias.data[idx2] = 0
-        linear.module.weight_raw.data[idx3, ...] = 0
-        linear.module.bias.data[idx3] = 0
-        linear.pruned_indices.extend([idx1, idx2, idx3])
-    indices.sort()
+    weight, bias = linear.module.weight_raw, linear.module.bias
+    norms = weight.data.norm(p=p, dim=1).view(3, -1)
+    scores = (norms / norms.max(1, keepdim=True)[0]).sum(0)
+    n = scores.size(0)
+    indices = scores.topk(int(percentage * (n - 1)), largest=False)[1].sort()[0]
+    indices = torch.cat([indices, indices + n, indices + 2 * n])
+    weight.data.index_fill_(0, indices, 0)
+    bias.data.index_fill_(0, indices, 0)
+    linear.pruned_indices = indices
+
+def _conv_modules(model):
+    return [m for m in model.modules() if isinstance(m, nn.modules.conv._ConvNd) and not m.transposed]
 
 def prune_global_norm(model, percentage, p=1):
-    global_scores = []
-    for module in filter(lambda x: isinstance(x, nn.Conv2d), model.modules()):
-        module.pruned_indices = []
-        norms = module.weight.view(module.weight.size(0), -1).norm(p=p, dim=1)
-        norm_sum = torch.sum(norms)
-        scores = norms / norm_sum
-        local_scores = []
-        for idx in range(module.weight.size(0)):
-            local_scores.append((scores[idx].item(), idx, module))
-        local_scores.sort(key=lambda x: x[0])
-        global_scores.extend(local_scores[:-1])
-    global_scores.sort(key=lambda x: x[0])
-    for _, idx, module in global_scores[:int(percentage * len(global_scores))]:
-        module.weight.data[idx, ...] = 0
-        module.bias.data[idx] = 0
-        module.pruned_indices.append(idx)
+    modules = _conv_modules(model)
+    if not modules:
+        return
+    scores = [_channel_scores(module, p) for module in modules]
+    for score in scores:
+        score[score.max(0)[1]] = float("inf") # keep the strongest channel of every layer
+    n_candidates = sum(s.size(0) - 1 for s in scores)
+    flat_scores = torch.cat([s.cpu() for s in scores])
+    selected = torch.zeros(flat_scores.size(0)).byte()
+    selected[flat_scores.topk(int(percentage * n_candidates), largest=False)[1]] = 1
+    offset = 0
+    for module, score in zip(modules, scores):
+        indices = selected[offset:offset + score.size(0)].nonzero().view(-1).to(module.weight.device)
+        offset += score.size(0)
+        _zero_channels(module, indices)
+        module.pruned_indices = indices
 
 def prune_local_norm(model, percentage, p=1):
-    for module in filter(lambda x: isinstance(x, nn.Conv2d), model.modules()):
-        module.pruned_indices = []
-        norms = module.weight.view(module.weight.size(0), -1).norm(p=p, dim=1)
-        norm_sum = torch.sum(norms)
-        scores = norms / norm_sum
-        local_scores = []
-        for idx in range(module.weight.size(0)):
-            local_scores.append((scores[idx].item(), idx, module))
-        local_scores.sort(key=lambda x: x[0])
-        for _, idx, module in local_scores[:int(percentage * len(local_scores[:-1]))]:
-            module.weight.data[idx, ...] = 0
-            module.bias.data[idx] = 0
-            module.pruned_indices.append(idx)
+    for module in _conv_modules(model):
+        scores = _channel_scores(module, p)
+        indices = scores.topk(int(percentage * (scores.size(0) - 1)), largest=False)[1].sort()[0]
+        _zero_channels(module, indices)
+        module.pruned_indices = indices
 
 def compute_multiply_factor(model):
     modules = filter(lambda x: isinstance(x, nn.Conv2d) or isinstance(x, nn.MaxPool2d), model.modules())
@@ -126,7 +104,7 @@ def compute_multiply_factor(model):
         factor_out = module.weight.size(0)
         factor_in -= last_pruned
         if hasattr(module, "pruned_indices"):
-            last_pruned = len(module.pruned_indices)
+            last_pruned = module.pruned_indices.numel()
             factor_out -= last_pruned
         mults += scale * factor_in * factor_out
     return mults
@@ -36,6 +36,18 @@ class CONCRETEDropout(nn.Module):
     def l0_loss(self):
         return (self.alpha - self.beta * math.log(-self.gamma / self.zeta)).sigmoid().sum()
 
+    def gate_values(self):
+        z = (self.alpha.sigmoid() * (self.zeta - self.gamma) + self.gamma).clamp(0, 1)
+        if self.use_scale:
+            z = z * self.scale
+        return z
+
+    def slice_(self, indices):
+        self.alpha.data = self.alpha.data.index_select(0, indices)
+        if self.use_scale:
+            self.scale.data = self.scale.data.index_select(0, indices)
+        self.size = indices.numel()
+
     def forward(self, x):
         if not self.active:
             return x
@@ -78,6 +90,13 @@ class AlphaDropout(nn.Module):
         self.mask.data[self.mask.data != 0] = 1
         return indices
 
+    def gate_values(self):
+        return self.mask if self.pruned else self.mask.clamp(*self.bounds)
+
+    def slice_(self, indices):
+        self.mask.data = self.mask.data.index_select(0, indices)
+        self.size = indices.numel()
+
     def forward(self, x):
         if not self.active:
             return x
@@ -110,6 +129,19 @@ class LinearMarkovDropout(nn.Module):
         self.fixed_size = fixed_size
         return self
 
+    def fixed_width(self, t, n_channels):
+        """Number of channels kept for a UniformTiedGenerator fixed at t, as in forward."""
+        min_length = int(self.min_length * n_channels)
+        size = int((n_channels - self.min_length) / (1 - self.end_prob))
+        return min(n_channels, min_length + round(t * size))
+
+    def rescale_factors(self, n_channels):
+        """Values the channels are divided by with rescale, as in forward."""
+        min_length = int(self.min_length * n_channels)
+        ones = torch.ones(min_length)
+        arange = torch.arange(1, self.end_prob, -(1 - self.end_prob) / (n_channels - min_length))
+        return torch.cat([ones, arange])
+
     def forward(self, x, refresh=True):
         if self.tied_root and refresh:
             self.tied_generator.reset()
@@ -136,9 +168,7 @@ class LinearMarkovDropout(nn.Module):
         x = x * z
         if self.rescale:
             if self._x_cache is None:
-                ones = torch.ones(min_length)
-                arange = torch.arange(1, self.end_prob, -(1 - self.end_prob) / (x.size(1) - min_length))
-                self._x_cache = torch.cat([ones, arange])
+                self._x_cache = self.rescale_factors(x.size(1))
                 if x.is_cuda:
                     self._x_cache = self._x_cache.cuda()
             if end_idx - min_length == 0:
@@ -0,0 +1,267 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from candle.proxy import *
+from candle.proxy import _ProxyConvNd
+from .dynamic import AlphaDropout, CONCRETEDropout, LinearMarkovDropout
+
+_weighted_types = (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d, ProxyLinear, _ProxyConvNd)
+_norm_types = (nn.modules.batchnorm._BatchNorm,)
+_constant_types = (nn.modules.pooling._MaxPoolNd, nn.modules.pooling._AvgPoolNd,
+    nn.modules.pooling._AdaptiveMaxPoolNd, nn.modules.pooling._AdaptiveAvgPoolNd, nn.modules.dropout._DropoutNd)
+_homogeneous_types = (nn.ReLU, nn.LeakyReLU) + _constant_types
+
+def _check_hooks(layer):
+    proxy = layer.weight_provider
+    while isinstance(proxy, ProxyDecorator):
+        if list(proxy.parameters()) or list(proxy.buffers()):
+            raise ValueError(f"{type(proxy).__name__} on {type(layer).__name__} holds per-weight state; "
+                "export or disable it before slicing channels!")
+        proxy = proxy.child
+
+def _layer_params(layer):
+    if isinstance(layer, ProxyLayer):
+        _check_hooks(layer)
+        params = layer.weight_provider.root.parameters()
+        return params[0], params[1] if len(params) > 1 else None
+    return layer.weight, layer.bias
+
+def _groups(layer):
+    return getattr(layer, "groups", 1)
+
+def _select(param, dim, indices):
+    param.data = param.data.index_select(dim, indices.to(param.device)).contiguous()
+    param.grad = None
+
+def _update_sizes(layer):
+    if isinstance(layer, ProxyLayer):
+        layer._sizes = layer.weight_provider.sizes.reify()
+        layer.reset_param_options()
+        layer = layer.weight_provider.root.layer
+    weight = layer.weight
+    if isinstance(layer, nn.Linear):
+        layer.out_features, layer.in_features = weight.size(0), weight.size(1)
+    elif isinstance(layer, nn.modules.conv._ConvNd):
+        layer.out_channels, layer.in_channels = weight.size(0), weight.size(1) * layer.groups
+
+def slice_outputs(layer, indices):
+    """Keeps only the output channels (rows) of a Linear, Conv or their proxies given by indices."""
+    if _groups(layer) > 1:
+        raise ValueError("Slicing grouped convolutions is unsupported!")
+    weight, bias = _layer_params(layer)
+    _select(weight, 0, indices)
+    if bias is not None:
+        _select(bias, 0, indices)
+    _update_sizes(layer)
+
+def input_indices(layer, indices, n_channels):
+    """Maps channel indices to input columns; a Linear after a flatten sees every channel n times in a row."""
+    weight, _ = _layer_params(layer)
+    in_size = weight.size(1)
+    if in_size == n_channels or not isinstance(layer, (nn.Linear, ProxyLinear)):
+        return indices
+    if in_size % n_channels:
+        raise ValueError(f"Cannot map {n_channels} channels onto {in_size} inputs!")
+    n_repeat = in_size // n_channels
+    offsets = torch.arange(0, n_repeat).long().to(indices.device)
+    return (indices.view(-1, 1) * n_repeat + offsets.view(1, -1)).view(-1)
+
+def slice_inputs(layer, indices, n_channels=None):
+    if _groups(layer) > 1:
+        raise ValueError("Slicing grouped convolutions is unsupported!")
+    weight, _ = _layer_params(layer)
+    if n_channels is not None:
+        indices = input_indices(layer, indices, n_channels)
+    _select(weight, 1, indices)
+    _update_sizes(layer)
+
+def slice_norm(norm, indices):
+    for param in (norm.weight, norm.bias):
+        if param is not None:
+            _select(param, 0, indices)
+    for name in ("running_mean", "running_var"):
+        buf = getattr(norm, name)
+        if buf is not None:
+            setattr(norm, name, buf.index_select(0, indices.to(buf.device)).contiguous())
+    norm.num_features = indices.numel()
+
+def _leaf_modules(model):
+    leaves = []
+    skip = set()
+    for name, module in model.named_modules():
+        if id(module) in skip:
+            continue
+        if isinstance(module, ProxyLayer):
+            skip.update(id(m) for m in module.modules())
+        elif list(module.children()):
+            continue
+        leaves.append((name, module))
+    return leaves
+
+def find_channel_specs(model, gate_types):
+    """
+    Pairs every gate module with the weighted layer producing its channels and the one consuming them,
+    following module registration order, which matches execution order for sequential models. Each
+    spec lists the modules between producer and gate (before) and between gate and consumer (after).
+    """
+    leaves = _leaf_modules(model)
+    specs = []
+    for i, (name, module) in enumerate(leaves):
+        if not isinstance(module, gate_types):
+            continue
+        producer = next((j for j in range(i - 1, -1, -1) if isinstance(leaves[j][1], _weighted_types)), None)
+        consumer = next((j for j in range(i + 1, len(leaves)) if isinstance(leaves[j][1], _weighted_types)), None)
+        if producer is None or consumer is None:
+            raise ValueError(f"No producing or consuming layer around {name}!")
+        specs.append(dict(gate=module, producer=leaves[producer][1], consumer=leaves[consumer][1],
+            before=[m for _, m in leaves[producer + 1:i]], after=[m for _, m in leaves[i + 1:consumer]]))
+    return specs
+
+def slice_channels(spec, indices):
+    """Slices the producer outputs, any norms in between and the consumer inputs of a spec."""
+    weight, _ = _layer_params(spec["producer"])
+    n_channels = weight.size(0)
+    slice_outputs(spec["producer"], indices)
+    for module in spec["before"] + spec["after"]:
+        if isinstance(module, _norm_types):
+            slice_norm(module, indices)
+        elif any(p is not None for p in module._parameters.values()):
+            raise ValueError(f"Cannot slice channels through {type(module).__name__}!")
+    slice_inputs(spec["consumer"], indices, n_channels)
+
+def export_slimmable(model, width, specs=None):
+    """
+    Exports a copy of a model trained with LinearMarkovDropout at one width: every dropout's producer
+    is cut to its first channels, and the norms in between and the consumer inputs follow. width is a
+    channel count or a fraction t as given to UniformTiedGenerator.fix. A rebias value is folded into
+    the producer bias when the dropout directly follows the producer; otherwise the dropout stays,
+    fixed at the new width, and adds it. With rescale, the kept channels' divisors are folded into the
+    producer (or last norm) rows or else into the consumer columns, so the export matches the model
+    under UniformTiedGenerator.fix. The returned model is meant for eval mode.
+    """
+    model = copy.deepcopy(model)
+    specs = find_channel_specs(model, LinearMarkovDropout) if specs is None else specs
+    for spec in specs:
+        dropout = spec["gate"]
+        weight, bias = _layer_params(spec["producer"])
+        n_channels = weight.size(0)
+        if isinstance(width, float):
+            n_kept = dropout.fixed_width(width, n_channels)
+        else:
+            n_kept = min(width, n_channels)
+        rebias = None
+        if dropout.rebias and n_kept < dropout.add_mask.size(0):
+            rebias = dropout.add_mask.data[n_kept]
+        rescale = None
+        if dropout.rescale and n_kept > int(dropout.min_length * n_channels):
+            rescale = 1 / dropout.rescale_factors(n_channels)[:n_kept].to(weight.device)
+        slice_channels(spec, torch.arange(0, n_kept).long())
+        if rebias is not None and not spec["before"] and bias is not None:
+            bias.data.add_(rebias)
+            dropout.rebias = False
+            rebias = None
+        if rescale is not None:
+            _fold_rescale(spec, rescale, rebias is None)
+        dropout.fix(n_kept)
+    model.eval()
+    return model
+
+def _scale_rows(layer, scale):
+    if isinstance(layer, _norm_types):
+        if not layer.affine:
+            raise ValueError("Cannot fold a gate into a non-affine norm!")
+        weight, bias = layer.weight, layer.bias
+    else:
+        weight, bias = _layer_params(layer)
+    weight.data.mul_(scale.view(-1, *[1] * (weight.dim() - 1)))
+    if bias is not None:
+        bias.data.mul_(scale)
+
+def _fold_rescale(spec, scale, rows=True):
+    norms = [i for i, module in enumerate(spec["before"]) if isinstance(module, _norm_types)]
+    target = spec["before"][norms[-1]] if norms else spec["producer"]
+    tail = spec["before"][norms[-1] + 1:] if norms else spec["before"]
+    if rows and all(isinstance(m, _homogeneous_types) for m in tail):
+        _scale_rows(target, scale)
+    elif all(isinstance(m, _homogeneous_types) for m in spec["after"]):
+        _scale_columns(spec["consumer"], scale)
+    else:
+        raise ValueError("Cannot fold the rescaling of a LinearMarkovDropout into its neighbours!")
+
+def _scale_columns(layer, scale):
+    weight, _ = _layer_params(layer)
+    scale = scale.to(weight.device)
+    indices = input_indices(layer, torch.arange(0, scale.numel()).long().to(weight.device), scale.numel())
+    scale = scale.index_select(0, indices)
+    weight.data.mul_(scale.view(1, -1, *[1] * (weight.dim() - 2)))
+
+def _removed_constants(spec, n_channels, n_dims):
+    """Value every channel takes at the consumer input once the gate has zeroed it."""
+    x = torch.zeros(1, n_channels, *[1] * n_dims)
+    with torch.no_grad():
+        for module in spec["after"]:
+            if isinstance(module, _constant_types):
+                continue
+            training = module.training
+            module.eval()
+            try:
+                x = module(x.to(next(module.parameters()).device) if list(module.parameters()) else x)
+            finally:
+                module.train(training)
+    return x.view(n_channels)
+
+def _fold_constants(consumer, values, removed, n_channels):
+    weight, bias = _layer_params(consumer)
+    if bias is None:
+        raise ValueError("Removed channels leave a constant that needs a bias in the consumer!")
+    columns = input_indices(consumer, removed, n_channels)
+    values = values.index_select(0, removed).to(weight.device)
+    values = values.view(-1, 1).expand(-1, columns.numel() // removed.numel()).contiguous().view(-1)
+    removed_weight = weight.data.index_select(1, columns.to(weight.device))
+    removed_weight = removed_weight.view(weight.size(0), columns.numel(), -1).sum(2)
+    bias.data.add_(removed_weight.matmul(values))
+
+def export_gates(model, threshold=1E-3, specs=None):
+    """
+    Removes the channels that active CONCRETEDropout or AlphaDropout gates zero out, in place. Every gate's
+    producer, the norms in between and the consumer lose the channels whose eval-mode gate value is at
+    most threshold, and the gate is deactivated into an identity. A removed channel that is not zero at the
+    consumer input (e.g. a norm between gate and consumer) is folded into the consumer bias; this is exact
+    for linear layers and convolutions without padding. Kept gate values are folded into the last affine
+    layer before the gate, or into the consumer columns, when only positively homogeneous ops (ReLU,
+    pooling, dropout) lie in between; otherwise the gate stays active on the kept channels.
+    """
+    specs = find_channel_specs(model, (CONCRETEDropout, AlphaDropout)) if specs is None else specs
+    for spec in specs:
+        gate = spec["gate"]
+        if not gate.active:
+            continue
+        weight, _ = _layer_params(spec["producer"])
+        n_channels = weight.size(0)
+        values = gate.gate_values().data.cpu()
+        keep = (values.abs() > threshold).nonzero().view(-1)
+        removed = (values.abs() <= threshold).nonzero().view(-1)
+        if removed.numel() > 0:
+            constants = _removed_constants(spec, n_channels, weight.dim() - 2)
+            if (constants.index_select(0, removed) != 0).any():
+                _fold_constants(spec["consumer"], constants, removed, n_channels)
+
+        kept_values = values.index_select(0, keep)
+        non_negative = bool((kept_values >= 0).all())
+        norms = [i for i, module in enumerate(spec["before"]) if isinstance(module, _norm_types)]
+        target = spec["before"][norms[-1]] if norms else spec["producer"]
+        tail = spec["before"][norms[-1] + 1:] if norms else spec["before"]
+        folded = True
+        if all(isinstance(m, _homogeneous_types) for m in tail) and (non_negative or not tail):
+            _scale_rows(target, values.to(weight.device))
+        elif all(isinstance(m, _homogeneous_types) for m in spec["after"]) and (non_negative or not spec["after"]):
+            _scale_columns(spec["consumer"], values)
+        else:
+            folded = False
+
+        slice_channels(spec, keep)
+        gate.slice_(keep.to(gate.gate_values().device))
+        gate.active = not folded
+    return model
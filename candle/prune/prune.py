@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import math
 
 from torch.autograd import Variable
@@ -6,25 +8,39 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
+from candle import distributed
 from candle.context import *
+from candle.cost import CostModel
 from candle.estimator import Function
 from candle.nested import *
 from candle.proxy import *
+from candle.proxy import _ProxyConvNd
+from .sparse import *
 
 class WeightMaskGroup(ProxyDecorator):
-    def __init__(self, layer, child, init_value=1, stochastic=False):
+    hook_options = ()
+    importance_methods = ()
+    compact_dim = None
+
+    def __init__(self, layer, child, init_value=1, stochastic=False, cache=None):
         super().__init__(layer, child)
         self.stochastic = stochastic
         self.masks = self.build_masks(init_value)
         self.frozen = False
+        self.group_cost = None
         self._flattened_masks = self.masks.reify(flat=True)
-        self.cache = Memoizer()
+        self.cache = Memoizer() if cache is None else cache
+        self._state_key = None
+        self.importance_method = None
+        self._importance_handle = None
+        self.reset_importance()
         self._reset_buffers()
 
     def _reset_buffers(self):
         if not self.stochastic:
             return
         self._frozen_samples = self.concrete_fn().clamp(0, 1).detach().data.reify(flat=True)
+        self._sample_names = [f"frozen_samples{i}" for i in range(len(self._frozen_samples))]
 
     def _build_masks(self, init_value, sizes, randomized_eval=False):
         if self.stochastic:
@@ -35,30 +51,168 @@ class WeightMaskGroup(ProxyDecorator):
 
     def buffers(self):
         if self.stochastic:
-            return [(f"frozen_samples{i}", sample) for i, sample in enumerate(self._frozen_samples)]
+            return list(zip(self._sample_names, self._frozen_samples))
         return []
 
     @property
     def frozen_samples(self):
         def fetch_samples():
-            samples = []
-            for i in range(1000000):
-                try:
-                    samples.append(Variable(getattr(self.layer, f"frozen_samples{i}")))
-                except AttributeError:
-                    break
-            return Package.reshape_into(self.concrete_fn().nested_shape, samples)
-        return self.cache("_samples", fetch_samples)
+            samples = [Variable(getattr(self.layer, name)) for name in self._sample_names]
+            return Package.reshape_into(self.concrete_fn.alpha.nested_shape, samples)
+        self._check_state()
+        return self.cache((id(self), "_samples"), fetch_samples, tag=("samples", id(self.layer)))
 
     @frozen_samples.setter
     def frozen_samples(self, samples):
-        for i, sample in enumerate(samples.data.reify(flat=True)):
-            getattr(self.layer, f"frozen_samples{i}").copy_(sample)
-        self.cache.delete("_samples")
+        for name, sample in zip(self._sample_names, samples.data.reify(flat=True)):
+            getattr(self.layer, name).copy_(sample)
+        self.cache.delete((id(self), "_samples"))
+        self.update_masks()
 
-    def expand_masks(self):
+    def _device(self):
+        return self.root.parameters()[0].device
+
+    def _check_state(self):
+        """Drops the caches if the masks or frozen samples were replaced or copied into, e.g. by load_state_dict."""
+        tensors = self._flattened_masks
+        if self.stochastic:
+            tensors = tensors + [getattr(self.layer, name) for name in self._sample_names]
+        key = tuple((t.data_ptr(), t._version) for t in tensors)
+        if key != self._state_key:
+            self.cache.invalidate(("samples", id(self.layer)))
+            self.update_masks()
+            self._state_key = key
+
+    def frozen_masks(self):
+        """Expanded masks of a frozen group, computed once per device until the masks change."""
+        def expand():
+            return self.expand_masks().apply_fn(lambda mask: mask.detach())
+        self._check_state()
+        return self.cache((id(self), "_expanded", self._device()), expand, tag=("frozen", id(self.layer)))
+
+    def active_indices(self):
+        """Indices of the nonzero entries of every (unexpanded) mask of a frozen group."""
+        def find_active():
+            return self.hard_masks().apply_fn(lambda mask: (mask.data.view(-1) != 0).nonzero().view(-1))
+        self._check_state()
+        return self.cache((id(self), "_active", self._device()), find_active, tag=("frozen", id(self.layer)))
+
+    def update_masks(self, masks=None):
+        """Drops the frozen caches; call after modifying the masks or frozen samples in place."""
+        self.cache.invalidate(("frozen", id(self.layer)))
+        if self.stochastic and self.concrete_fn.sampler is not None:
+            self.concrete_fn.sampler.invalidate_expected()
+
+    def compact(self):
+        """
+        For frozen output or input channel masks, the weights restricted to the active channels and
+        scaled by their mask values. Autograd then only computes the active part of the layer, and
+        pruned channels get no gradient.
+        """
+        if not self.frozen or self.compact_dim is None or getattr(self.layer, "groups", 1) > 1:
+            return None
+        if self.importance_method == "taylor" and torch.is_grad_enabled():
+            return None
+        indices = self.active_indices().reify(flat=True)[0]
+        if indices.numel() == 0:
+            return None
+        def select_values():
+            return self.hard_masks().reify(flat=True)[0].data.view(-1).index_select(0, indices)
+        values = self.cache((id(self), "_values", self._device()), select_values, tag=("frozen", id(self.layer)))
+        weights = self.child().reify()
+        weight = weights[0].index_select(self.compact_dim, indices)
+        shape = [1] * weight.dim()
+        shape[self.compact_dim] = -1
+        compact_weights = [weight * values.view(*shape)]
+        if len(weights) > 1:
+            bias = weights[1]
+            if self.compact_dim == 0:
+                bias = bias.index_select(0, indices) * values
+            elif self.bias_factor() is not None:
+                bias = bias * self.bias_factor()
+            compact_weights.append(bias)
+        return compact_weights, indices, self.compact_dim
+
+    def bias_factor(self):
+        """Multiplier an input channel mask applies to the bias, if any."""
+        return None
+
+    def expand_masks(self, masks=None):
         raise NotImplementedError
 
+    def _gate(self, masks=None):
+        if masks is not None:
+            return masks.reify(flat=True)[0]
+        return self.sample_concrete().singleton() if self.stochastic else self._flattened_masks[0]
+
+    def track_importance(self, method="taylor"):
+        """
+        Starts accumulating a per-gate importance during training, read by the matching rank method.
+        "taylor" sums the squared loss gradient of every gate (Molchanov et al. 2019), taken from
+        a ones probe multiplied into the gates. "grad_activation" sums |activation * gradient| over
+        the gated output (or input) channels (Molchanov et al. 2017), from a forward hook.
+        """
+        if method not in self.importance_methods:
+            raise ValueError(f"{type(self).__name__} does not support {method} importance!")
+        self.stop_tracking()
+        self.reset_importance()
+        self.importance_method = method
+        if method == "grad_activation":
+            self._importance_handle = self.layer.register_forward_hook(self._record_activation)
+
+    def stop_tracking(self):
+        if self._importance_handle is not None:
+            self._importance_handle.remove()
+            self._importance_handle = None
+        self.importance_method = None
+
+    def reset_importance(self):
+        self._importance = {}
+        self.importance_count = 0
+
+    @property
+    def importance(self):
+        """Accumulated importance averaged over steps (taylor) or samples (grad_activation), shaped like the gates."""
+        if self.importance_count == 0:
+            return None
+        gates = self.concrete_fn.alpha if self.stochastic else self.masks
+        scores = []
+        for i, gate in enumerate(gates.reify(flat=True)):
+            score = self._importance.get(i)
+            scores.append(gate.data.new(gate.size()).zero_() if score is None else score / self.importance_count)
+        return Package.reshape_into(gates.nested_shape, scores)
+
+    def _accumulate(self, i, scores, count):
+        if i in self._importance:
+            self._importance[i].add_(scores)
+        else:
+            self._importance[i] = scores.clone()
+        self.importance_count += count
+
+    def _probe_gates(self):
+        gates = self.hard_masks() if self.frozen else self.sample_concrete() if self.stochastic else self.masks
+        def probe(gate, i):
+            ones = Variable(gate.data.new(gate.size()).fill_(1), requires_grad=True)
+            ones.register_hook(lambda grad: self._accumulate(i, grad.data**2, int(i == 0)))
+            return (gate.detach() if self.frozen else gate) * ones
+        probed = [probe(gate, i) for i, gate in enumerate(gates.reify(flat=True))]
+        return Package.reshape_into(gates.nested_shape, probed)
+
+    def _record_activation(self, layer, inputs, output):
+        x = output if self.compact_dim == 0 else inputs[0]
+        if not torch.is_grad_enabled() or not x.requires_grad:
+            return
+        data = x.data
+        def accumulate(grad):
+            product = data * grad.data
+            if isinstance(self.layer, _ProxyConvNd):
+                scores = product.view(product.size(0), product.size(1), -1).sum(2).abs().sum(0)
+                self._accumulate(0, scores, product.size(0))
+            else:
+                product = product.contiguous().view(-1, product.size(-1))
+                self._accumulate(0, product.abs().sum(0), product.size(0))
+        x.register_hook(accumulate)
+
     def apply(self, weights=None):
         def apply_mask(weight, mask):
             weight.data.copy_((weight * mask).data)
@@ -74,19 +228,38 @@ class WeightMaskGroup(ProxyDecorator):
 
     @property
     def n_groups(self):
-        total_params = sum(self.expand_masks().numel().reify(flat=True))
-        group_params = sum(self.masks.numel().reify(flat=True))
-        return float(total_params / group_params)
+        def compute_n_groups():
+            total_params = sum(self.expand_masks().numel().reify(flat=True))
+            return float(total_params / self.n_masks)
+        tensors = self.masks.reify(flat=True) + self.root().reify(flat=True)
+        sizes = tuple(tuple(tensor.size()) for tensor in tensors)
+        return self.cache((id(self), "n_groups", sizes), compute_n_groups, tag=("frozen", id(self.layer)))
 
-    def l0_loss(self, lambd):
+    @property
+    def n_masks(self):
+        return sum(self.masks.numel().reify(flat=True))
+
+    def l0_loss(self, lambd, cost=None):
+        """
+        Expected L0 norm of the gates, each weighted by cost, the group_cost set by
+        GroupPruneContext.set_l0_costs, or by default the number of weights it gates.
+        """
         if not self.stochastic:
             raise ValueError("Mask group must be in stochastic mode!")
+        if cost is None:
+            cost = self.n_groups if self.group_cost is None else self.group_cost
         cdf_gt0 = self.concrete_fn.cdf_gt0()
-        return lambd * sum((self.n_groups * cdf_gt0).sum().reify(flat=True))
+        return lambd * sum((cost * cdf_gt0).sum().reify(flat=True))
 
     def parameters(self):
         return self._flattened_masks
 
+    def hard_masks(self):
+        """Deterministic masks in [0, 1]: the masks themselves, the frozen samples or the expected gates."""
+        if not self.stochastic:
+            return self.masks
+        return self.frozen_samples if self.frozen else self.concrete_fn.expected().clamp(0, 1)
+
     def sample_concrete(self):
         if not self.stochastic:
             raise ValueError("Mask group must be in stochastic mode!")
@@ -98,14 +271,16 @@ class WeightMaskGroup(ProxyDecorator):
             return (self.sample_concrete() != 0).long().sum().data[0].reify()
 
     def freeze(self, refresh=True):
-        if not self.stochastic or self.frozen:
+        if self.frozen:
             return
         self.frozen = True
-        if refresh:
+        if self.stochastic and refresh:
             self.frozen_samples = self.concrete_fn().clamp(0, 1).detach()
+        self.update_masks()
 
     def unfreeze(self):
         self.frozen = False
+        self.update_masks()
 
     def print_info(self):
         super().print_info()
@@ -116,7 +291,9 @@ class WeightMaskGroup(ProxyDecorator):
         return self.child.sizes
 
     def call(self, input):
-        masks = self.expand_masks()
+        if self.importance_method == "taylor" and torch.is_grad_enabled():
+            return input * self.expand_masks(self._probe_gates())
+        masks = self.frozen_masks() if self.frozen else self.expand_masks()
         return input * masks
 
 class HardConcreteFunction(Function):
@@ -134,18 +311,25 @@ class HardConcreteFunction(Function):
         self.context = context
         self.randomized_eval = randomized_eval
         self.optimize_beta = optimize_beta
+        self.generator = None
+        self.sampler = None
 
     def __call__(self):
+        if self.sampler is not None:
+            return self.sampler(self)
         self.beta.data.clamp_(1E-8, 1E8)
         self.alpha.data.clamp_(1E-8, 1E8)
         if self.context.training or self.randomized_eval:
-            u = self.alpha.apply_fn(lambda x: x.clone().uniform_())
+            u = self.alpha.apply_fn(lambda x: x.clone().uniform_(generator=self.generator))
             s = (u.log() - (1 - u).log() + self.alpha.log()) / (self.beta + 1E-6)
             mask = s.sigmoid() * (self.zeta - self.gamma) + self.gamma
         else:
-            mask = self.alpha.log().sigmoid() * (self.zeta - self.gamma) + self.gamma
+            mask = self.expected()
         return mask
 
+    def expected(self):
+        return self.alpha.log().sigmoid() * (self.zeta - self.gamma) + self.gamma
+
     def cdf_gt0(self):
         return (self.alpha.log() - self.beta * np.log(-self.gamma / self.zeta)).sigmoid()
 
@@ -162,34 +346,211 @@ class HardConcreteFunction(Function):
         beta = sizes.apply_fn(lambda x: nn.Parameter(torch.Tensor(x).fill_(2 / 3)))
         return cls(context, alpha, beta, **kwargs)
 
+class HardConcreteSampler(object):
+    """
+    Samples the hard concrete gates of many HardConcreteFunctions together: one uniform_ call and one
+    logit transform over a flat noise buffer per step, split into per-function views. Each function then
+    turns its view into gates with its own alphas, so every gate has its own small graph and a backward
+    through one leaves the others usable. A function asking for a second sample, or asking after an
+    optimizer step, triggers a fresh draw for everyone. Eval-mode masks are cached while gradients are
+    disabled, until an alpha changes, the masks are updated or a training sample is drawn.
+    """
+
+    def __init__(self):
+        self.functions = []
+        self.generator = None
+        self.invalidate()
+
+    def register(self, function):
+        function.sampler = self
+        self.functions.append(function)
+        self.invalidate()
+
+    def invalidate(self):
+        self._samples = {}
+        self._views = None
+        self._marker = None
+        self._marker_version = None
+        self._noise = None
+        self._constants = None
+        self.invalidate_expected()
+
+    def invalidate_expected(self):
+        self._expected = None
+        self._expected_key = None
+
+    def _params(self, name):
+        return [p for fn in self.functions for p in getattr(fn, name).reify(flat=True)]
+
+    def _flat(self, params):
+        return torch.cat([p.view(-1) for p in params])
+
+    def _scale_shift(self, like):
+        if self._constants is None or self._constants[0].device != like.device:
+            scale, shift = [], []
+            for fn in self.functions:
+                n = sum(a.numel() for a in fn.alpha.reify(flat=True))
+                scale.append(like.data.new(n).fill_(fn.zeta - fn.gamma))
+                shift.append(like.data.new(n).fill_(fn.gamma))
+            self._constants = (torch.cat(scale), torch.cat(shift))
+        return self._constants
+
+    def _split(self, flat):
+        outputs = {}
+        offset = 0
+        for fn in self.functions:
+            leaves = []
+            for alpha in fn.alpha.reify(flat=True):
+                leaves.append(flat[offset:offset + alpha.numel()].view_as(alpha))
+                offset += alpha.numel()
+            outputs[id(fn)] = Package.reshape_into(fn.alpha.nested_shape, leaves)
+        return outputs
+
+    def _stepped(self):
+        # optimizers update every alpha in place, so one version counter marks the step
+        return self._marker is None or self._marker._version != self._marker_version
+
+    def sample(self):
+        alphas, betas = self._params("alpha"), self._params("beta")
+        for param in alphas + betas:
+            param.data.clamp_(1E-8, 1E8)
+        n = sum(alpha.numel() for alpha in alphas)
+        if self._noise is None or self._noise.numel() != n or self._noise.device != alphas[0].device:
+            self._noise = alphas[0].data.new(n)
+            self._views = self._split(self._noise)
+        u = self._noise.uniform_(generator=self.generator)
+        u.div_(1 - u).log_()
+        self._samples = dict(self._views)
+        self._marker, self._marker_version = alphas[0], alphas[0]._version
+        self._expected = None
+
+    def expected(self, function):
+        if torch.is_grad_enabled():
+            return function.expected()
+        alphas = self._params("alpha")
+        key = tuple(p._version for p in alphas)
+        if self._expected is None or key != self._expected_key:
+            alpha = self._flat(alphas)
+            scale, shift = self._scale_shift(alpha)
+            self._expected = self._split(alpha.log().sigmoid() * scale + shift)
+            self._expected_key = key
+        return self._expected[id(function)]
+
+    def __call__(self, function):
+        if function.context.training or function.randomized_eval:
+            if id(function) not in self._samples or self._stepped():
+                self.sample()
+            logits = self._samples.pop(id(function))
+            s = (logits + function.alpha.log()) / (function.beta + 1E-6)
+            return s.sigmoid() * (function.zeta - function.gamma) + function.gamma
+        return self.expected(function)
+
 class RNNMask(WeightMaskGroup):
+    """
+    Hidden unit masks for LSTM, GRU and vanilla RNNs, one per layer and direction. A unit's rows are
+    masked in every gate of weight_ih, weight_hh and the biases, along with its columns in weight_hh
+    and in the next layer's weight_ih. The gate count is read from the weight shapes.
+    """
+    importance_methods = ("taylor",)
+
     def __init__(self, layer, child, **kwargs):
         super().__init__(layer, child, **kwargs)
-        self.expand_masks()
 
-    def build_masks(self, init_value): # TODO: bidirectional support
-        sizes = self.child.sizes.reify()
-        self._expand_size = Package([[size[1][0] // size[1][1]] * 4 for size in sizes])
-        mask_sizes = [size[1][1] for size in sizes]
-        return self._build_masks(init_value, mask_sizes, randomized_eval=False)
+    @property
+    def n_directions(self):
+        return 2 if self.layer.child.bidirectional else 1
 
-    def expand_masks(self):
-        def expand_mask(size, mask, expand_size):
-            for _ in range(len(size) - 1):
-                mask = mask.unsqueeze(0)
-            if len(size) == 2:
-                return mask.expand(size[1], -1).repeat(1, expand_size).permute(1, 0)
-            else:
-                return mask.repeat(expand_size)
+    def build_masks(self, init_value):
+        mask_sizes = [size[1][1] for size in self.child.sizes.reify()]
+        if self.stochastic:
+            return self._build_masks(init_value, Package(mask_sizes), randomized_eval=False)
+        return Package([nn.Parameter(init_value * torch.ones(size)) for size in mask_sizes])
+
+    def _layer_masks(self, masks=None):
+        if masks is not None:
+            return masks.reify(flat=True)
         if self.stochastic:
-            mask = self.sample_concrete().singleton()
+            return self.sample_concrete().reify(flat=True)
+        return self._flattened_masks
+
+    def split(self, root):
+        splits = []
+        for weights in root().reify():
+            hidden = weights[1].size(1)
+            n_gates = weights[0].size(0) // hidden
+            parts = [w.view(n_gates, hidden, -1).permute(0, 2, 1).contiguous().view(-1, hidden) for w in weights]
+            splits.append(torch.cat(parts, 0))
+        return Package.reshape_into(self.masks.nested_shape, splits)
+
+    def expand_masks(self, masks=None):
+        masks = self._layer_masks(masks)
+        n_dirs = self.n_directions
+        expanded = []
+        for i, sizes in enumerate(self.child.sizes.reify()):
+            mask = masks[i]
+            n_gates = sizes[1][0] // sizes[1][1]
+            rows = mask.unsqueeze(0).expand(n_gates, mask.size(0)).contiguous().view(-1)
+            if i < n_dirs:
+                cols_ih = rows.new(sizes[0][1]).fill_(1)
+            else:
+                layer = i // n_dirs
+                cols_ih = torch.cat([masks[(layer - 1) * n_dirs + d] for d in range(n_dirs)])
+            weights = [rows.unsqueeze(1) * cols_ih.unsqueeze(0), rows.unsqueeze(1) * mask.unsqueeze(0)]
+            expanded.append(weights + [rows] * (len(sizes) - 2))
+        return Package(expanded)
+
+    def export(self):
+        """
+        Builds a plain nn.LSTM, nn.GRU or nn.RNN without the pruned hidden units. PyTorch needs one
+        hidden size for every layer and direction, so all of them keep the size of the widest one;
+        narrower ones are padded with pruned (dead) units. Returns the module and the indices of the
+        original output features it produces, for slicing the input of the next layer.
+        """
+        rnn = self.layer.child
+        masks = [m.data for m in self._layer_masks(self.hard_masks())]
+        weights = self.child().reify()
+        expanded = self.expand_masks(Package(masks)).reify()
+        kept = [(m != 0).nonzero().view(-1) for m in masks]
+        hidden = max(max(k.numel() for k in kept), 1)
+        indices = []
+        for mask, keep in zip(masks, kept):
+            pad = (mask == 0).nonzero().view(-1)[:hidden - keep.numel()]
+            indices.append(torch.cat([keep, pad]).sort()[0])
+
+        kwargs = dict(num_layers=rnn.num_layers, bias=rnn.bias, batch_first=rnn.batch_first,
+            dropout=rnn.dropout, bidirectional=rnn.bidirectional)
+        if rnn.mode == "LSTM":
+            module = nn.LSTM(rnn.input_size, hidden, **kwargs)
+        elif rnn.mode == "GRU":
+            module = nn.GRU(rnn.input_size, hidden, **kwargs)
+        elif rnn.mode in ("RNN_TANH", "RNN_RELU"):
+            module = nn.RNN(rnn.input_size, hidden, nonlinearity=rnn.mode[4:].lower(), **kwargs)
         else:
-            raise ValueError("Only stochastic masks supported currently!")
-        mask_package = Package([[m] * 4 for m in mask.reify()])
-        expand_weight = self.child.sizes.apply_fn(expand_mask, mask_package, self._expand_size)
-        return expand_weight
+            raise ValueError(f"RNN mode {rnn.mode} unsupported!")
+
+        n_dirs = self.n_directions
+        old_hidden = rnn.hidden_size
+        for i, (params, layer_weights, layer_masks) in enumerate(zip(module.all_weights, weights, expanded)):
+            index = indices[i]
+            n_gates = layer_weights[0].size(0) // old_hidden
+            rows = (torch.arange(0, n_gates).long().view(-1, 1) * old_hidden + index.view(1, -1)).view(-1)
+            values = [(w * m).data.index_select(0, rows.to(w.device)) for w, m in zip(layer_weights, layer_masks)]
+            if i >= n_dirs:
+                layer = i // n_dirs
+                cols = torch.cat([indices[(layer - 1) * n_dirs + d] + d * old_hidden for d in range(n_dirs)])
+                values[0] = values[0].index_select(1, cols.to(values[0].device))
+            values[1] = values[1].index_select(1, index.to(values[1].device))
+            for param, value in zip(params, values):
+                param.data.copy_(value)
+        last = (rnn.num_layers - 1) * n_dirs
+        output_indices = torch.cat([indices[last + d] + d * old_hidden for d in range(n_dirs)])
+        return module, output_indices
+
+class ChannelMask(WeightMaskGroup):
+    """Output channel mask for convolutions of any dimension."""
+    importance_methods = ("taylor", "grad_activation")
+    compact_dim = 0
 
-class Channel2DMask(WeightMaskGroup):
     def __init__(self, layer, child, **kwargs):
         super().__init__(layer, child, **kwargs)
 
@@ -201,17 +562,55 @@ class Channel2DMask(WeightMaskGroup):
         split_root = param.view(param.size(0), -1).permute(1, 0)
         return Package([split_root])
 
-    def expand_masks(self):
-        if self.stochastic:
-            mask = self.sample_concrete().singleton()
-        else:
-            mask = self._flattened_masks[0]
-        sizes = self.child.sizes.reify()[0]
-        expand_weight = mask.expand(sizes[3], sizes[2], sizes[1], -1).permute(3, 2, 1, 0)
-        expand_bias = mask
-        return Package([expand_weight, expand_bias])
+    def expand_masks(self, masks=None):
+        mask = self._gate(masks)
+        sizes = self.child.sizes.reify()
+        expand_weight = mask.view(-1, *[1] * (len(sizes[0]) - 1)).expand(*sizes[0])
+        return Package([expand_weight, mask][:len(sizes)])
+
+Channel2DMask = ChannelMask
+
+class ChannelInMask(WeightMaskGroup):
+    """
+    Input channel mask for convolutions of any dimension. With groups > 1 the weight only holds
+    in_channels / groups inputs per output channel, so input channel c maps to column c % (in / groups)
+    of the output channels in group c // (in / groups); depthwise convs are the case in / groups == 1.
+    """
+    importance_methods = ("taylor", "grad_activation")
+    compact_dim = 1
+
+    def __init__(self, layer, child, **kwargs):
+        super().__init__(layer, child, **kwargs)
+
+    @property
+    def groups(self):
+        return self.layer.groups
+
+    def build_masks(self, init_value):
+        size = self.child.sizes.reify()[0]
+        return self._build_masks(init_value, size[1] * self.groups)
+
+    def split(self, root):
+        param = root.parameters()[0]
+        size = param.size()
+        split_root = param.view(self.groups, size[0] // self.groups, size[1], -1).permute(1, 3, 0, 2)
+        return Package([split_root.contiguous().view(-1, size[1] * self.groups)])
+
+    def expand_masks(self, masks=None):
+        mask = self._gate(masks)
+        sizes = self.child.sizes.reify()
+        size = sizes[0]
+        mask_2d = mask.view(self.groups, 1, size[1]).expand(self.groups, size[0] // self.groups, size[1])
+        mask_2d = mask_2d.contiguous().view(size[0], size[1])
+        expand_weight = mask_2d.view(*mask_2d.size(), *[1] * (len(size) - 2)).expand(*size)
+        if len(sizes) == 1:
+            return Package([expand_weight])
+        return Package([expand_weight, mask.new(sizes[1]).fill_(1)])
 
 class LinearRowMask(WeightMaskGroup):
+    importance_methods = ("taylor", "grad_activation")
+    compact_dim = 0
+
     def __init__(self, layer, child, **kwargs):
         super().__init__(layer, child, **kwargs)
 
@@ -221,13 +620,16 @@ class LinearRowMask(WeightMaskGroup):
     def split(self, root):
         return Package([root.parameters()[0].permute(1, 0)])
 
-    def expand_masks(self):
-        mask = self.sample_concrete().singleton() if self.stochastic else self._flattened_masks[0]
+    def expand_masks(self, masks=None):
+        mask = self._gate(masks)
         expand_weight = mask.expand(self.child.sizes.reify()[0][1], -1).permute(1, 0)
         expand_bias = mask
         return Package([expand_weight, expand_bias])
 
 class LinearColMask(WeightMaskGroup):
+    importance_methods = ("taylor", "grad_activation")
+    compact_dim = 1
+
     def __init__(self, layer, child, **kwargs):
         super().__init__(layer, child, **kwargs)
         self._dummy = nn.Parameter(torch.ones(child.sizes.reify()[1][0]))
@@ -239,32 +641,192 @@ class LinearColMask(WeightMaskGroup):
     def split(self, root):
         return Package([root.parameters()[0]])
 
-    def expand_masks(self):
-        mask = self.concrete_fn().clamp(0, 1).singleton() if self.stochastic else self._flattened_masks[0]
+    def expand_masks(self, masks=None):
+        mask = self._gate(masks)
         expand_weight = mask.expand(self.child.sizes.reify()[0][0], -1)
         expand_bias = self._dummy
         return Package([expand_weight, expand_bias])
 
+    def bias_factor(self):
+        return self._dummy.detach()
+
+class NMMask(WeightMaskGroup):
+    """
+    N:M semi-structured mask: at most n of every m consecutive input-channel weights survive.
+    Deterministic masks keep the n largest magnitudes of each group; stochastic masks learn one
+    hard concrete gate per weight and keep the n largest gates of each group.
+    """
+    hook_options = ("n", "m")
+
+    def __init__(self, layer, child, n=2, m=4, **kwargs):
+        self.n = n
+        self.m = m
+        super().__init__(layer, child, **kwargs)
+
+    def build_masks(self, init_value):
+        sizes = self.child.sizes.reify()[0]
+        if sizes[1] % self.m != 0:
+            raise ValueError(f"Input size {sizes[1]} not divisible by m={self.m}!")
+        if self.stochastic:
+            return self._build_masks(init_value, sizes)
+        return Package([], children_type=nn.Parameter)
+
+    def split(self, root):
+        weight = root.parameters()[0]
+        return Package([weight.unsqueeze(0)])
+
+    def _nm_masks(self, weights):
+        weight = weights[0]
+        if self.stochastic:
+            gates = self.sample_concrete().singleton()
+            weight_mask = nm_select(gates.data, self.n, self.m) * gates
+        else:
+            weight_mask = nm_select(weight.data.abs(), self.n, self.m)
+        masks = [weight_mask]
+        masks.extend(w.data.new(w.size()).fill_(1) for w in weights[1:])
+        return Package(masks)
+
+    def expand_masks(self):
+        return self._nm_masks(self.child().reify())
+
+    def call(self, input):
+        if self.frozen:
+            return input * self.frozen_masks()
+        return input * self._nm_masks(input.reify())
+
+    def pack(self):
+        weights = self().reify()
+        return pack_nm(weights[0].data, self.n, self.m)
+
+    def export(self):
+        if not isinstance(self.layer, ProxyLinear):
+            raise ValueError("Packed N:M execution only supports ProxyLinear!")
+        weights = self().reify()
+        bias = weights[1].data if len(weights) > 1 else None
+        return NMSparseLinear.from_dense(weights[0].data, self.n, self.m, bias=bias)
+
+class LinearBlockMask(WeightMaskGroup):
+    """
+    Masks fixed-size (rows x cols) tiles of a ProxyLinear weight; biases are left unmasked.
+    """
+    hook_options = ("block",)
+
+    def __init__(self, layer, child, block=(8, 8), **kwargs):
+        self.block = tuple(block)
+        super().__init__(layer, child, **kwargs)
+
+    def build_masks(self, init_value):
+        size = self.child.sizes.reify()[0]
+        if size[0] % self.block[0] != 0 or size[1] % self.block[1] != 0:
+            raise ValueError(f"Weight size {tuple(size)} not divisible by block {self.block}!")
+        return self._build_masks(init_value, torch.Size([size[0] // self.block[0], size[1] // self.block[1]]))
+
+    def split(self, root):
+        tiles = block_layout(root.parameters()[0], self.block)
+        return Package([tiles.contiguous().view(tiles.size(0), tiles.size(1), -1).permute(2, 0, 1)])
+
+    def expand_masks(self):
+        mask = self.sample_concrete().singleton() if self.stochastic else self._flattened_masks[0]
+        masks = [expand_block_mask(mask, self.block)]
+        masks.extend(mask.data.new(size).fill_(1) for size in self.child.sizes.reify()[1:])
+        return Package(masks)
+
+    def export(self):
+        weights = self().reify()
+        bias = weights[1].data if len(weights) > 1 else None
+        return BlockSparseLinear.from_dense(weights[0].data, self.block, bias=bias)
+
 class WeightMask(ProxyDecorator):
     def __init__(self, layer, child, init_value=1, stochastic=False):
         super().__init__(layer, child)
         def create_mask(size):
             return nn.Parameter(torch.ones(*size) * init_value)
-        self.masks = child.sizes.reify().apply_fn(create_mask)
-        self._flattened_masks = self.masks.reify(flat=True)
+        self._masks = child.sizes.apply_fn(create_mask)
+        self._flattened_masks = self._masks.reify(flat=True)
         self.stochastic = stochastic
+        self.hardened = False
+        self.cache_masks = False
+        self._packed_names = []
+        self._keep_cache = None
 
     def parameters(self):
         return self._flattened_masks
 
+    @property
+    def masks(self):
+        if not self.hardened:
+            return self._masks
+        return self.keep_masks().apply_fn(lambda keep: keep.float())
+
+    def keep_masks(self):
+        def unpack():
+            packed = [getattr(self.layer, name) for name in self._packed_names]
+            return Package.reshape_into(self._nested_shape, [unpack_bits(p, size) for p, size in zip(packed,
+                self._sizes)])
+        if not self.cache_masks:
+            return unpack()
+        if self._keep_cache is None or self._keep_cache.reify(flat=True)[0].device != self._device():
+            self._keep_cache = unpack()
+        return self._keep_cache
+
+    def _device(self):
+        return getattr(self.layer, self._packed_names[0]).device
+
+    def harden(self, cache=False):
+        """
+        Replaces the float mask parameters with 1-bit masks packed into uint8 buffers of the layer.
+        Stochastic masks keep the elements with keep probability above 0.5. With cache, the unpacked
+        masks are kept between forward passes, trading memory for speed. The masks stop being trainable.
+        """
+        if self.hardened:
+            return
+        masks = self._masks
+        if self.stochastic:
+            masks = masks.apply_fn(lambda mask: mask.data.clamp(0, 1) > 0.5)
+        self._nested_shape = self._masks.nested_shape
+        self._sizes = [mask.size() for mask in self._flattened_masks]
+        mask_ids = set(id(mask) for mask in self._flattened_masks)
+        for name, param in list(self.layer._parameters.items()):
+            if id(param) in mask_ids:
+                del self.layer._parameters[name]
+        prefix = "packed_mask{}".format(len([n for n in self.layer._buffers if n.startswith("packed_mask")]))
+        for i, mask in enumerate(masks.reify(flat=True)):
+            name = f"{prefix}_{i}"
+            self.layer.register_buffer(name, pack_bits(mask.data))
+            self._packed_names.append(name)
+        self.hardened = True
+        self.cache_masks = cache
+        self._masks = None
+        self._flattened_masks = []
+
+    def update_masks(self, masks=None):
+        """
+        Repacks hardened masks after their unpacked copies (from masks) were modified, and drops the
+        unpacked cache, e.g. after the packed buffers were overwritten.
+        """
+        if not self.hardened:
+            return
+        if masks is not None:
+            for name, mask in zip(self._packed_names, masks.reify(flat=True)):
+                getattr(self.layer, name).copy_(pack_bits(mask.data))
+        self._keep_cache = None
+
+    @property
+    def n_unpruned(self):
+        if self.hardened:
+            return sum(int(keep.long().sum()) for keep in self.keep_masks().reify(flat=True))
+        return sum(float(mask.data.sum()) for mask in self._flattened_masks)
+
     @property
     def sizes(self):
         return self.child.sizes
 
     def call(self, input):
+        if self.hardened:
+            return input.apply_fn(lambda x, keep: x.masked_fill(keep == 0, 0), self.keep_masks())
         if self.stochastic:
-            return input * self.masks.clamp(0, 1).bernoulli()
-        return input * self.masks
+            return input * self._masks.clamp(0, 1).bernoulli()
+        return input * self._masks
 
 def _group_rank_norm(context, proxies, p=1):
     return [proxy.split(proxy.root).norm(p, 0) for proxy in proxies]
@@ -275,15 +837,42 @@ def _group_rank_l1(context, proxies):
 def _group_rank_l2(context, proxies):
     return _group_rank_norm(context, proxies, p=2)
 
-def _single_rank_magnitude(context, proxies):
-    providers = context.list_providers()
-    ranks = [provider.package.abs() for provider in providers]
+def _group_rank_block_norm(context, proxies, p=1):
+    def rank(proxy):
+        split = proxy.split(proxy.root)
+        return split.norm(p, 0) / split.size(0).reify()[0]**(1 / p)
+    return [rank(proxy) for proxy in proxies]
+
+def _group_rank_block_l1(context, proxies):
+    return _group_rank_block_norm(context, proxies, p=1)
+
+def _group_rank_block_l2(context, proxies):
+    return _group_rank_block_norm(context, proxies, p=2)
+
+def _group_rank_tracked(context, proxies, method):
+    """Accumulated importance per proxy; None (not pruned) for proxies not tracked with method."""
+    ranks = [proxy.importance if getattr(proxy, "importance_method", None) == method else None
+        for proxy in proxies]
+    if proxies and all(rank is None for rank in ranks):
+        raise ValueError(f"No {method} importance accumulated; call track_importance and train first!")
     return ranks
 
+def _group_rank_taylor(context, proxies):
+    return _group_rank_tracked(context, proxies, "taylor")
+
+def _group_rank_grad_activation(context, proxies):
+    return _group_rank_tracked(context, proxies, "grad_activation")
+
+def _single_rank_magnitude(context, proxies):
+    return [proxy.root.package.abs() for proxy in proxies]
+
 _single_rank_methods = dict(magnitude=_single_rank_magnitude)
-_group_rank_methods = dict(l1_norm=_group_rank_l1, l2_norm=_group_rank_l2)
+_group_rank_methods = dict(l1_norm=_group_rank_l1, l2_norm=_group_rank_l2, block_l1_norm=_group_rank_block_l1,
+    block_l2_norm=_group_rank_block_l2, taylor=_group_rank_taylor, grad_activation=_group_rank_grad_activation)
 
 class PruneContext(Context):
+    mask_type = WeightMask
+
     def __init__(self, stochastic=False, **kwargs):
         super().__init__(**kwargs)
         self.stochastic = stochastic
@@ -303,45 +892,320 @@ class PruneContext(Context):
         return self.list_mask_params(inverse=True)
 
     def count_unpruned(self):
-        return sum(p.sum().cpu().data[0] for p in self.list_mask_params())
+        return sum(proxy.n_unpruned for proxy in self.list_proxies("weight_hook", WeightMask))
 
-    def clip_all_masks(self):
-        for p in self.list_mask_params():
-            p.data.clamp_(0, 1)
+    def harden(self, cache=False):
+        for proxy in self.list_proxies("weight_hook", WeightMask):
+            proxy.harden(cache=cache)
 
-    def prune(self, percentage, method="magnitude", method_map=_single_rank_methods, mask_type=WeightMask):
+    def clip_all_masks(self):
+        for proxy in self.list_proxies("weight_hook", self.mask_type):
+            if getattr(proxy, "stochastic", False) and isinstance(proxy, WeightMaskGroup) or not proxy.parameters():
+                continue
+            for p in proxy.parameters():
+                p.data.clamp_(0, 1)
+            proxy.update_masks()
+
+    def update_masks(self):
+        """Drops the caches derived from every mask; call after modifying masks or their buffers in place."""
+        for proxy in self.list_proxies("weight_hook", self.mask_type):
+            proxy.update_masks()
+
+    def broadcast_parameters(self, src=0, group=None):
+        super().broadcast_parameters(src, group=group)
+        self.update_masks()
+
+    def broadcast_buffers(self, src=0, group=None):
+        super().broadcast_buffers(src, group=group)
+        self.update_masks()
+
+    def prune(self, percentage, method="magnitude", method_map=_single_rank_methods, mask_type=WeightMask,
+            scope="local", bins=None, alive=None, proxies=None):
+        """
+        Prunes percentage of the currently unmasked weights, ranked by method. With scope="local"
+        every mask loses that share of its weights; with scope="global" one threshold is chosen
+        across all masks. bins selects a streaming histogram instead of a concatenated top-k.
+        alive is an optional dict of unmasked indices per mask, reused and updated across calls.
+        proxies restricts pruning to the given mask proxies.
+        """
+        proxies, proxy_masks, pairs = self._rank_pairs(method, method_map, mask_type, proxies)
+        selected = list(select_pruned(pairs, percentage, scope=scope, bins=bins, alive=alive))
+        self._commit_pruned(proxies, proxy_masks, selected, alive)
+
+    def prune_async(self, percentage, method="magnitude", method_map=_single_rank_methods, mask_type=WeightMask,
+            scope="local", bins=None, alive=None, proxies=None):
+        """
+        Like prune, but only the masks and rank inputs are snapshotted (to the CPU) here; ranking and
+        selection run on a background thread while training continues. Returns an AsyncPrune whose commit(), called
+        at a step boundary, swaps the pruned entries into the live masks.
+        """
+        rank_call = method_map[method]
+        if proxies is None:
+            proxies = self.list_proxies("weight_hook", mask_type)
+        snapshots = [[_snapshot(mask) for mask in proxy.masks.reify(flat=True)] for proxy in proxies]
+        private_alive = None
+        if alive is not None:
+            private_alive = {}
+            for proxy, copies in zip(proxies, snapshots):
+                for mask, snapshot in zip(proxy.masks.reify(flat=True), copies):
+                    if id(mask) in alive:
+                        private_alive[id(snapshot)] = alive[id(mask)].cpu()
+        rank_inputs = [_RankInputs(proxy) for proxy in proxies]
+        if getattr(self, "_prune_executor", None) is None:
+            self._prune_executor = ThreadPoolExecutor(max_workers=1)
+        def select():
+            with torch.no_grad():
+                weights_list = rank_call(self, rank_inputs)
+            pairs = []
+            for weights, copies in zip(weights_list, snapshots):
+                if weights is not None:
+                    pairs.extend(zip(weights.reify(flat=True), copies))
+            return list(select_pruned(pairs, percentage, scope=scope, bins=bins, alive=private_alive))
+        return AsyncPrune(self, self._prune_executor.submit(select), method, proxies, snapshots, alive,
+            private_alive)
+
+    def _rank_pairs(self, method, method_map, mask_type, proxies):
         rank_call = method_map[method]
-        proxies = self.list_proxies("weight_hook", mask_type)
+        if proxies is None:
+            proxies = self.list_proxies("weight_hook", mask_type)
         weights_list = rank_call(self, proxies)
-        for weights, proxy in zip(weights_list, proxies):
-            for weight, mask in flatten_zip(weights.reify(), proxy.masks.reify()):
-                _, indices = torch.sort(weight.view(-1))
-                ne0_indices = indices[mask.view(-1)[indices] != 0]
-                if ne0_indices.size(0) <= 1:
-                    continue
-                length = math.ceil(ne0_indices.size(0) * percentage / 100)
-                indices = ne0_indices[:length]
-                if indices.size(0) > 0:
-                    mask.data.view(-1)[indices.data] = 0
+        pairs = []
+        proxy_masks = [proxy.masks for proxy in proxies]
+        for weights, masks in zip(weights_list, proxy_masks):
+            if weights is not None:
+                pairs.extend(flatten_zip(weights.reify(), masks.reify()))
+        self._ranked(proxies, method)
+        return proxies, proxy_masks, pairs
+
+    def _ranked(self, proxies, method):
+        pass
+
+    def _commit_pruned(self, proxies, proxy_masks, selected, alive=None):
+        for mask, indices in selected:
+            mask.data.view(-1)[indices.to(mask.device)] = 0
+            if alive is not None and id(mask) in alive:
+                remaining = alive[id(mask)]
+                alive[id(mask)] = remaining[(mask.data.view(-1)[remaining] != 0).nonzero().view(-1)]
+        for proxy, masks in zip(proxies, proxy_masks):
+            proxy.update_masks(masks)
+            if getattr(proxy, "hardened", False):
+                if alive is not None:
+                    for mask in masks.reify(flat=True):
+                        alive.pop(id(mask), None)
+
+    def mask_sparsity(self, mask_type=None):
+        report = []
+        for proxy in self.list_proxies("weight_hook", mask_type or self.mask_type):
+            masks = proxy.masks.reify(flat=True)
+            n_zero = sum(int((mask.data == 0).long().sum()) for mask in masks)
+            report.append((proxy.layer, n_zero / sum(mask.numel() for mask in masks)))
+        return report
+
+def _snapshot(tensor):
+    data = tensor.data
+    return data.cpu() if data.is_cuda else data.clone()
+
+class _RankInputs(object):
+    """
+    Stands in for a proxy in the rank methods, with its root weights and accumulated importance
+    snapshotted so a background ranking never reads tensors the optimizer or hooks are updating.
+    """
+
+    def __init__(self, proxy):
+        self.split = getattr(proxy, "split", None)
+        self.root = copy.copy(proxy.root)
+        self.root.package = proxy.root.package.apply_fn(_snapshot)
+        self.root._flattened_params = self.root.package.reify(flat=True)
+        self.importance_method = getattr(proxy, "importance_method", None)
+        self.importance = None
+        if self.importance_method is not None and proxy.importance is not None:
+            self.importance = proxy.importance.apply_fn(_snapshot)
+
+class AsyncPrune(object):
+    """
+    Pending background pruning step returned by PruneContext.prune_async. A proxy whose masks were
+    hardened, or whose pruned entries changed, after the snapshot is skipped at commit and listed
+    in skipped.
+    """
+
+    def __init__(self, context, future, method, proxies, snapshots, alive=None, private_alive=None):
+        self.context = context
+        self.future = future
+        self.method = method
+        self.proxies = proxies
+        self.snapshots = snapshots
+        self.hardened = [getattr(proxy, "hardened", False) for proxy in proxies]
+        self.alive = alive
+        self.private_alive = private_alive
+        self.skipped = []
+        self.committed = False
+
+    def done(self):
+        return self.future.done()
+
+    def _unchanged(self, proxy, hardened, masks, copies):
+        if getattr(proxy, "hardened", False) != hardened:
+            return False
+        return all(bool(((mask.data != 0).cpu() == (copy != 0)).all()) for mask, copy in zip(masks, copies))
+
+    def commit(self, wait=True):
+        """
+        Zeroes the selected entries in the live masks and returns True; with wait=False, returns False
+        instead of blocking when the ranking and selection have not finished yet.
+        """
+        if self.committed:
+            return True
+        if not wait and not self.future.done():
+            return False
+        result = self.future.result()
+        proxies, proxy_masks, originals = [], [], {}
+        for proxy, hardened, copies in zip(self.proxies, self.hardened, self.snapshots):
+            masks = proxy.masks
+            flat_masks = masks.reify(flat=True)
+            if not self._unchanged(proxy, hardened, flat_masks, copies):
+                self.skipped.append(proxy)
+                continue
+            proxies.append(proxy)
+            proxy_masks.append(masks)
+            originals.update((id(copy), mask) for mask, copy in zip(flat_masks, copies))
+        selected = [(originals[id(copy)], indices) for copy, indices in result if id(copy) in originals]
+        if self.alive is not None:
+            for key, indices in self.private_alive.items():
+                mask = originals.get(key)
+                if mask is not None and id(mask) not in self.alive:
+                    self.alive[id(mask)] = indices.to(mask.device)
+        self.context._commit_pruned(proxies, proxy_masks, selected, self.alive)
+        self.context._ranked(self.proxies, self.method)
+        self.committed = True
+        return True
+
+def _unmasked_scores(pairs, alive=None):
+    for weight, mask in pairs:
+        indices = None if alive is None else alive.get(id(mask))
+        if indices is None:
+            indices = (mask.data.view(-1) != 0).nonzero().view(-1)
+        else:
+            # masks may have been pruned outside of prune() since alive was filled
+            indices = indices[(mask.data.view(-1)[indices] != 0).nonzero().view(-1)]
+        if alive is not None:
+            alive[id(mask)] = indices
+        if indices.numel() <= 1:
+            continue
+        yield mask, indices, weight.data.view(-1)[indices]
+
+def _histogram_threshold(scores, k, bins):
+    """Approximate k-th smallest score, or None when there is nothing to rank."""
+    scores = [s for s in scores if s.numel() > 0]
+    if not scores:
+        return None
+    lo = min(s.min().item() for s in scores)
+    hi = max(s.max().item() for s in scores)
+    if hi <= lo:
+        return lo
+    counts = sum(torch.histc(s.float(), bins, lo, hi).cpu() for s in scores)
+    cumulative = counts.cumsum(0)
+    b = int((cumulative < k).long().sum())
+    width = (hi - lo) / bins
+    left, right = lo + b * width, lo + (b + 1) * width
+    remaining = k - (int(cumulative[b - 1]) if b > 0 else 0)
+    in_bin = [s[(s >= left) & (s <= right)].cpu() for s in scores]
+    in_bin = [s for s in in_bin if s.numel() > 0]
+    if not in_bin:
+        return None
+    in_bin = torch.cat(in_bin)
+    return in_bin.kthvalue(min(remaining, in_bin.numel()))[0].item()
+
+def select_pruned(pairs, percentage, scope="local", bins=None, alive=None):
+    """
+    Yields (mask, flat indices) for the lowest scoring unmasked entries of each (score, mask) pair.
+    """
+    entries = list(_unmasked_scores(pairs, alive))
+    if scope == "local":
+        for mask, indices, scores in entries:
+            k = math.ceil(scores.numel() * percentage / 100)
+            if k > 0:
+                yield mask, indices[scores.topk(k, largest=False)[1]]
+        return
+    elif scope != "global":
+        raise ValueError(f"Unknown pruning scope {scope}!")
+
+    total = sum(scores.numel() for _, _, scores in entries)
+    k = math.ceil(total * percentage / 100)
+    if k == 0:
+        return
+    if bins is not None:
+        threshold = _histogram_threshold([scores for _, _, scores in entries], k, bins)
+        if threshold is None:
+            return
+        for mask, indices, scores in entries:
+            yield mask, indices[scores <= threshold]
+        return
+    flat_scores = torch.cat([scores.cpu() for _, _, scores in entries])
+    selected = torch.zeros(total).byte()
+    selected[flat_scores.topk(k, largest=False)[1]] = 1
+    offset = 0
+    for mask, indices, scores in entries:
+        n = scores.numel()
+        chosen = selected[offset:offset + n].nonzero().view(-1)
+        offset += n
+        if chosen.numel() > 0:
+            yield mask, indices[chosen.to(indices.device)]
 
 class GroupPruneContext(PruneContext):
+    mask_type = WeightMaskGroup
+    supported_types = (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.Linear, nn.modules.rnn.RNNBase)
+
     def __init__(self, stochastic=False, frozen=False, **kwargs):
         super().__init__(**kwargs)
         self.stochastic = stochastic
         self.frozen = frozen
+        self.sampler = HardConcreteSampler()
 
     def compose(self, layer, **kwargs):
         layer = super().compose(layer, **kwargs)
-        layer.hook_weight(self.find_mask_type(type(layer), kwargs.get("prune", "out")), stochastic=self.stochastic)
+        mask_type = self.find_mask_type(type(layer), kwargs.get("prune", "out"))
+        options = {name: kwargs[name] for name in mask_type.hook_options if name in kwargs}
+        mask = layer.hook_weight(mask_type, stochastic=self.stochastic, cache=self.cache, **options)
+        if self.stochastic:
+            self.sampler.register(mask.concrete_fn)
         return layer
 
-    def l0_loss(self, lambd):
+    def l0_loss(self, lambd, costs=None):
+        """costs optionally maps mask groups to per-group cost weights, overriding their group_cost."""
         group_masks = self.list_proxies("weight_hook", WeightMaskGroup)
         loss = 0
         for mask in group_masks:
-            loss = loss + mask.l0_loss(lambd)
+            cost = None if costs is None else costs.get(mask)
+            loss = loss + mask.l0_loss(lambd, cost=cost)
         return loss
 
+    def set_l0_costs(self, model, *inputs, latency=False, normalize=True, cost_model=None):
+        """
+        Sets the group_cost of every stochastic mask group to the MACs (or, with latency=True, the
+        measured seconds of its own layer) that one of its gates controls, traced on inputs; convs
+        therefore count their output spatial size. With normalize, costs are rescaled so that the total penalty of
+        a dense model matches the default parameter-count weighting and lambd keeps its scale.
+        """
+        cost_model = CostModel(model) if cost_model is None else cost_model
+        cost_model.trace(*inputs)
+        if latency and any(entry.latency is None for entry in cost_model.layers):
+            cost_model.calibrate()
+        costs = {}
+        for entry in cost_model.layers:
+            mask = entry.layer.find_provider(WeightMaskGroup) if isinstance(entry.layer, ProxyLayer) else None
+            if mask is None or not mask.stochastic:
+                continue
+            cost = (entry.latency or 0) if latency else entry.dense_macs
+            costs[mask] = costs.get(mask, 0) + cost / mask.n_masks
+        if normalize and costs:
+            n_weights = sum(mask.n_groups * mask.n_masks for mask in costs)
+            total_cost = sum(cost * mask.n_masks for mask, cost in costs.items())
+            scale = n_weights / total_cost if total_cost > 0 else 1
+            costs = {mask: cost * scale for mask, cost in costs.items()}
+        for mask, cost in costs.items():
+            mask.group_cost = cost
+        return costs
+
     def apply(self):
         group_masks = self.list_proxies("weight_hook", WeightMaskGroup)
         for mask in group_masks:
@@ -351,19 +1215,49 @@ class GroupPruneContext(PruneContext):
         group_masks = self.list_proxies("weight_hook", WeightMaskGroup)
         for mask in group_masks:
             mask.freeze(refresh=refresh)
+        if refresh and distributed.is_distributed():
+            self.broadcast_buffers()
+
+    def sync_rng(self, seed=None):
+        if distributed.is_distributed():
+            seed = distributed.broadcast_seed(seed)
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.sampler.generator = self.generator
+        for mask in self.list_proxies("weight_hook", WeightMaskGroup):
+            if mask.stochastic:
+                mask.concrete_fn.generator = self.generator
+        return seed
 
     def unfreeze(self):
         group_masks = self.list_proxies("weight_hook", WeightMaskGroup)
         for mask in group_masks:
             mask.unfreeze()
 
+    def track_importance(self, method="taylor"):
+        """Accumulates method importance on every mask group supporting it during the following steps."""
+        for mask in self.list_proxies("weight_hook", WeightMaskGroup):
+            if method in mask.importance_methods:
+                mask.track_importance(method)
+
+    def stop_tracking(self):
+        for mask in self.list_proxies("weight_hook", WeightMaskGroup):
+            mask.stop_tracking()
+
     def find_mask_type(self, layer_type, prune="out"):
-        if layer_type == ProxyLinear and prune == "out":
+        if prune == "nm" and issubclass(layer_type, (ProxyLinear, _ProxyConvNd)):
+            return NMMask
+        elif layer_type == ProxyLinear and prune == "block":
+            return LinearBlockMask
+        elif layer_type == ProxyLinear and prune == "out":
             return LinearRowMask
         elif layer_type == ProxyLinear and prune == "in":
             return LinearColMask
-        elif layer_type == ProxyConv2d  and prune == "out":
-            return Channel2DMask
+        elif issubclass(layer_type, _ProxyConvNd) and prune == "out":
+            return ChannelMask
+        elif issubclass(layer_type, _ProxyConvNd) and prune == "in":
+            return ChannelInMask
         elif layer_type == ProxyRNN:
             return RNNMask
         else:
@@ -378,5 +1272,21 @@ class GroupPruneContext(PruneContext):
         group_masks = self.list_proxies("weight_hook", WeightMaskGroup)
         return sum(sum((m.expand_masks() != 0).float().sum().cpu().data[0].reify(flat=True)) for m in group_masks)
 
-    def prune(self, percentage, method="l2_norm", method_map=_group_rank_methods, mask_type=WeightMaskGroup):
-        super().prune(percentage, method, method_map, mask_type)
+    def prune(self, percentage, method="l2_norm", method_map=_group_rank_methods, mask_type=WeightMaskGroup,
+            scope="local", bins=None, alive=None, proxies=None):
+        """
+        With a tracked method (taylor, grad_activation), the accumulated importance is consumed and reset;
+        proxies without accumulated importance for that method are left as they are.
+        """
+        super().prune(percentage, method, method_map, mask_type, scope=scope, bins=bins, alive=alive,
+            proxies=proxies)
+
+    def prune_async(self, percentage, method="l2_norm", method_map=_group_rank_methods, mask_type=WeightMaskGroup,
+            scope="local", bins=None, alive=None, proxies=None):
+        return super().prune_async(percentage, method, method_map, mask_type, scope=scope, bins=bins, alive=alive,
+            proxies=proxies)
+
+    def _ranked(self, proxies, method):
+        for proxy in proxies:
+            if getattr(proxy, "importance_method", None) == method:
+                proxy.reset_importance()
@@ -0,0 +1,60 @@
+class PruneScheduler(object):
+    """
+    Gradual pruning from "To prune, or not to prune" (Zhu and Gupta, 2017). Sparsity follows
+    s_f + (s_i - s_f) * (1 - (t - t_0) / (t_1 - t_0))^power between begin_step and end_step,
+    and the context is pruned every frequency steps to stay on the curve.
+    """
+
+    def __init__(self, context, final_sparsity, begin_step=0, end_step=10000, frequency=100,
+            initial_sparsity=0, power=3, **prune_kwargs):
+        self.context = context
+        self.final_sparsity = final_sparsity
+        self.initial_sparsity = initial_sparsity
+        self.begin_step = begin_step
+        self.end_step = end_step
+        self.frequency = frequency
+        self.power = power
+        self.prune_kwargs = prune_kwargs
+        self.alive = {}
+        self.step_count = 0
+        self.history = []
+
+    def target_sparsity(self, step):
+        if step <= self.begin_step:
+            return self.initial_sparsity if step == self.begin_step else 0
+        progress = min(1, (step - self.begin_step) / (self.end_step - self.begin_step))
+        delta = self.initial_sparsity - self.final_sparsity
+        return self.final_sparsity + delta * (1 - progress)**self.power
+
+    def sparsity(self):
+        return self.context.mask_sparsity(self._mask_type())
+
+    def total_sparsity(self):
+        n_zero = n_total = 0
+        for proxy in self.context.list_proxies("weight_hook", self._mask_type()):
+            for mask in proxy.masks.reify(flat=True):
+                n_zero += int((mask.data == 0).long().sum())
+                n_total += mask.numel()
+        return n_zero / max(n_total, 1)
+
+    def _mask_type(self):
+        return self.prune_kwargs.get("mask_type", self.context.mask_type)
+
+    def step(self, step=None):
+        """
+        Advances the schedule and prunes if step is a pruning step. Returns the per-layer
+        sparsity report when pruning happened and None otherwise.
+        """
+        step = self.step_count if step is None else step
+        self.step_count = step + 1
+        if step < self.begin_step or step > self.end_step or (step - self.begin_step) % self.frequency:
+            return None
+        target = self.target_sparsity(step)
+        current = self.total_sparsity()
+        if target <= current:
+            return None
+        percentage = 100 * (target - current) / (1 - current)
+        self.context.prune(percentage, alive=self.alive, **self.prune_kwargs)
+        report = self.sparsity()
+        self.history.append((step, target, report))
+        return report
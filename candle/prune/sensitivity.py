@@ -0,0 +1,169 @@
+import torch
+import torch.multiprocessing as mp
+
+from candle.cost import CostModel
+from candle.proxy import ProxyLayer
+
+def accuracy(model, batches):
+    n_correct = n_total = 0
+    for x, y in batches:
+        n_correct += int((model(x).max(1)[1] == y).long().sum())
+        n_total += y.size(0)
+    return n_correct / max(n_total, 1)
+
+def _mask_sparsity(proxy):
+    masks = proxy.masks.reify(flat=True)
+    n_zero = sum(int((mask.data == 0).long().sum()) for mask in masks)
+    return n_zero / sum(mask.numel() for mask in masks)
+
+def _privatize(proxy):
+    """
+    Points the proxy's masks at private copies so pruning them leaves the (possibly shared) originals
+    untouched; returns what _restore needs to undo it.
+    """
+    if getattr(proxy, "hardened", False):
+        names = proxy._packed_names
+        originals = [proxy.layer._buffers[name] for name in names]
+        for name, buf in zip(names, originals):
+            proxy.layer._buffers[name] = buf.clone()
+    else:
+        originals = []
+        for mask in proxy.masks.reify(flat=True):
+            originals.append(mask.data)
+            mask.data = mask.data.clone()
+    proxy.update_masks()
+    return originals
+
+def _restore(proxy, originals):
+    if getattr(proxy, "hardened", False):
+        for name, buf in zip(proxy._packed_names, originals):
+            proxy.layer._buffers[name] = buf
+    else:
+        for mask, data in zip(proxy.masks.reify(flat=True), originals):
+            mask.data = data
+    proxy.update_masks()
+
+_worker_state = None
+
+def _init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+def _run_job(job):
+    return _worker_state.evaluate_level(*job)
+
+class SensitivityAnalysis(object):
+    """
+    Per-layer pruning sensitivity: every masked layer is pruned alone to each level, evaluated on a
+    cached list of validation batches and restored. Only that layer's masks are copied. With
+    n_workers > 0 the model and batches are moved to shared memory and the sweep runs in a forked
+    process pool (CPU models only), each worker applying its own mask deltas.
+    """
+
+    def __init__(self, context, model, batches, metric=accuracy, levels=(10, 30, 50, 70, 90),
+            n_batches=None, **prune_kwargs):
+        self.context = context
+        self.model = model
+        self.metric = metric
+        self.levels = levels
+        self.prune_kwargs = prune_kwargs
+        self.batches = []
+        for batch in batches:
+            if n_batches is not None and len(self.batches) >= n_batches:
+                break
+            self.batches.append(tuple(batch))
+        self.proxies = context.list_proxies("weight_hook", prune_kwargs.get("mask_type", context.mask_type))
+        names = {id(module): name for name, module in model.named_modules()}
+        self.names = [names.get(id(proxy.layer), str(i)) for i, proxy in enumerate(self.proxies)]
+        self.curves = None
+        self.baseline = None
+
+    def evaluate(self):
+        training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                return self.metric(self.model, self.batches)
+        finally:
+            self.model.train(training)
+
+    def evaluate_level(self, index, level):
+        proxy = self.proxies[index]
+        originals = _privatize(proxy)
+        try:
+            self.context.prune(level, proxies=[proxy], **self.prune_kwargs)
+            return index, level, _mask_sparsity(proxy), self.evaluate()
+        finally:
+            _restore(proxy, originals)
+
+    def run(self, n_workers=0):
+        """Returns {layer name: [(level, sparsity, score), ...]}, also stored in curves."""
+        global _worker_state
+        self.baseline = self.evaluate()
+        jobs = [(i, level) for i in range(len(self.proxies)) for level in self.levels]
+        on_cuda = any(p.is_cuda for p in self.model.parameters())
+        if n_workers > 0 and not on_cuda:
+            self.model.share_memory()
+            for batch in self.batches:
+                for tensor in batch:
+                    if torch.is_tensor(tensor):
+                        tensor.share_memory_()
+            _worker_state = self
+            n_threads = max(1, torch.get_num_threads() // n_workers)
+            try:
+                with mp.get_context("fork").Pool(n_workers, _init_worker, (n_threads,)) as pool:
+                    results = pool.map(_run_job, jobs)
+            finally:
+                _worker_state = None
+        else:
+            results = [self.evaluate_level(*job) for job in jobs]
+        self.curves = {name: [] for name in self.names}
+        for index, level, sparsity, score in results:
+            self.curves[self.names[index]].append((level, sparsity, score))
+        return self.curves
+
+    def allocate(self, flop_budget, *inputs):
+        """
+        Greedily raises per-layer pruning levels, always taking the step that loses the least score
+        per MAC saved, until the model's MACs (traced on inputs, by default the first cached batch)
+        fit flop_budget; a budget <= 1 is read as a fraction of the dense MACs. MACs of a layer are
+        assumed to shrink with its mask density, starting from its current sparsity. Returns
+        {layer name: level} and the estimated MACs.
+        """
+        if self.curves is None:
+            self.run()
+        cost_model = CostModel(self.model)
+        cost_model.trace(*(inputs or self.batches[0][:1]))
+        macs = {id(entry.layer): entry.dense_macs for entry in cost_model.layers}
+        layer_macs = [macs.get(id(proxy.layer), 0) for proxy in self.proxies]
+        total = sum(macs.values())
+        budget = flop_budget * total if flop_budget <= 1 else flop_budget
+        sparsities = [_mask_sparsity(proxy) for proxy in self.proxies]
+        steps = [[(0, sparsity, self.baseline)] + sorted(self.curves[name])
+            for sparsity, name in zip(sparsities, self.names)]
+        position = [0] * len(self.proxies)
+        current = total - sum(sparsity * n_macs for sparsity, n_macs in zip(sparsities, layer_macs))
+        while current > budget:
+            best = None
+            for i, curve in enumerate(steps):
+                if position[i] + 1 >= len(curve) or layer_macs[i] == 0:
+                    continue
+                _, sparsity, score = curve[position[i]]
+                _, next_sparsity, next_score = curve[position[i] + 1]
+                saved = (next_sparsity - sparsity) * layer_macs[i]
+                if saved <= 0:
+                    continue
+                ratio = (score - next_score) / saved
+                if best is None or ratio < best[0]:
+                    best = (ratio, i, saved)
+            if best is None:
+                break
+            _, i, saved = best
+            position[i] += 1
+            current -= saved
+        allocation = {name: steps[i][position[i]][0] for i, name in enumerate(self.names)}
+        return allocation, current
+
+    def apply(self, allocation):
+        for proxy, name in zip(self.proxies, self.names):
+            if allocation.get(name):
+                self.context.prune(allocation[name], proxies=[proxy], **self.prune_kwargs)
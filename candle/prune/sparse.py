@@ -0,0 +1,192 @@
+import torch
+import torch.nn as nn
+
+def pack_bits(mask):
+    """Packs the nonzero pattern of mask into a flat uint8 tensor, 8 elements per byte."""
+    bits = (mask.contiguous().view(-1) != 0).long()
+    pad = (-bits.numel()) % 8
+    if pad:
+        bits = torch.cat([bits, bits.new(pad).zero_()])
+    weights = torch.LongTensor([128, 64, 32, 16, 8, 4, 2, 1]).to(bits.device)
+    return (bits.view(-1, 8) * weights).sum(1).byte()
+
+def unpack_bits(packed, size):
+    """Inverse of pack_bits: a byte (or bool) tensor of the given size, nonzero where kept."""
+    weights = torch.ByteTensor([128, 64, 32, 16, 8, 4, 2, 1]).to(packed.device)
+    bits = (packed.view(-1, 1) & weights) != 0
+    n_elements = 1
+    for dim in size:
+        n_elements *= dim
+    return bits.view(-1)[:n_elements].view(*size)
+
+def nm_layout(weight):
+    """
+    Views a weight as (out, in) with input channels innermost, so that N:M groups run along
+    input channels at every kernel position.
+    """
+    if weight.dim() > 2:
+        weight = weight.permute(0, *range(2, weight.dim()), 1)
+    return weight.contiguous().view(weight.size(0), -1)
+
+def nm_unlayout(matrix, size):
+    if len(size) <= 2:
+        return matrix.view(*size)
+    n_dims = len(size)
+    matrix = matrix.view(size[0], *size[2:], size[1])
+    return matrix.permute(0, n_dims - 1, *range(1, n_dims - 1))
+
+def nm_select(scores, n, m):
+    matrix = nm_layout(scores)
+    groups = matrix.view(-1, m)
+    mask = groups.new(groups.size()).zero_().scatter_(1, groups.topk(n, 1)[1], 1)
+    return nm_unlayout(mask.view_as(matrix), scores.size())
+
+def pack_nm(weight, n, m):
+    """
+    Packs an N:M sparse weight into values of shape (out, in * n / m) and uint8 indices giving
+    the position of every value inside its group of m.
+    """
+    matrix = nm_layout(weight)
+    groups = matrix.view(matrix.size(0), -1, m)
+    indices = groups.abs().topk(n, 2)[1].sort(2)[0]
+    values = groups.gather(2, indices)
+    return values.view(matrix.size(0), -1), indices.view(matrix.size(0), -1).byte()
+
+def unpack_nm(values, indices, n, m, size):
+    n_rows = values.size(0)
+    groups = values.new(n_rows, values.size(1) // n, m).zero_()
+    groups.scatter_(2, indices.long().view(n_rows, -1, n), values.view(n_rows, -1, n))
+    return nm_unlayout(groups.view(n_rows, -1), size)
+
+class NMSparseLinear(nn.Module):
+    """
+    Linear layer over N:M packed weights. The CPU path builds a sparse matrix from the packed
+    values and group indices and multiplies with it; the matrix is rebuilt whenever values or
+    indices are modified in place (e.g. by load_state_dict) or moved.
+    """
+
+    def __init__(self, values, indices, n, m, bias=None):
+        super().__init__()
+        self.n = n
+        self.m = m
+        self.out_features = values.size(0)
+        self.in_features = values.size(1) * m // n
+        self.register_buffer("values", values.contiguous())
+        self.register_buffer("indices", indices.contiguous())
+        self.bias = None if bias is None else nn.Parameter(bias.clone())
+        self._sparse_weight = None
+        self._sparse_key = None
+
+    @classmethod
+    def from_dense(cls, weight, n, m, bias=None):
+        values, indices = pack_nm(weight, n, m)
+        return cls(values, indices, n, m, bias=bias)
+
+    def to_dense(self):
+        return unpack_nm(self.values, self.indices, self.n, self.m, (self.out_features, self.in_features))
+
+    def sparse_weight(self):
+        key = tuple((t.data_ptr(), t._version, t.device) for t in (self.values, self.indices))
+        if self._sparse_weight is None or key != self._sparse_key:
+            n_groups = self.in_features // self.m
+            rows = torch.arange(0, self.out_features).long().view(-1, 1).expand(-1, n_groups * self.n)
+            offsets = torch.arange(0, n_groups).long().view(1, -1, 1) * self.m
+            cols = (offsets + self.indices.long().view(self.out_features, n_groups, self.n).cpu())
+            coords = torch.stack([rows.contiguous().view(-1), cols.view(-1)]).to(self.values.device)
+            self._sparse_weight = torch.sparse_coo_tensor(coords, self.values.view(-1),
+                (self.out_features, self.in_features)).coalesce()
+            self._sparse_key = key
+        return self._sparse_weight
+
+    def forward(self, x):
+        x_2d = x.contiguous().view(-1, self.in_features)
+        out = torch.sparse.mm(self.sparse_weight(), x_2d.t()).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.view(*x.size()[:-1], self.out_features)
+
+def block_layout(weight, block):
+    n_rows, n_cols = weight.size(0) // block[0], weight.size(1) // block[1]
+    return weight.contiguous().view(n_rows, block[0], n_cols, block[1]).permute(0, 2, 1, 3)
+
+def expand_block_mask(mask, block):
+    n_rows, n_cols = mask.size()
+    mask = mask.view(n_rows, 1, n_cols, 1).expand(n_rows, block[0], n_cols, block[1])
+    return mask.contiguous().view(n_rows * block[0], n_cols * block[1])
+
+class BlockSparseLinear(nn.Module):
+    """
+    Linear layer that stores only the nonzero (rows x cols) tiles of its weight. The tiles of each
+    block row are laid out as one panel (padded to the fullest block row), so the forward pass is
+    a single gather of the needed input columns and one batched matmul; zero tiles cost nothing.
+    """
+
+    def __init__(self, blocks, block_rows, block_cols, out_features, in_features, bias=None):
+        super().__init__()
+        self.block = tuple(blocks.size()[1:])
+        self.out_features = out_features
+        self.in_features = in_features
+        self.register_buffer("blocks", blocks.contiguous())
+        self.register_buffer("block_rows", block_rows)
+        self.register_buffer("block_cols", block_cols)
+        self.bias = None if bias is None else nn.Parameter(bias.clone())
+        self._panels = None
+        self._panels_key = None
+
+    @classmethod
+    def from_dense(cls, weight, block, bias=None):
+        tiles = block_layout(weight, block)
+        nonzero = (tiles.contiguous().view(tiles.size(0), tiles.size(1), -1) != 0).sum(2) > 0
+        coords = nonzero.nonzero()
+        if coords.size(0) == 0:
+            coords = weight.new(0, 2).long()
+            blocks = weight.new(0, *block)
+        else:
+            blocks = tiles[coords[:, 0], coords[:, 1]]
+        return cls(blocks, coords[:, 0].contiguous(), coords[:, 1].contiguous(), weight.size(0),
+            weight.size(1), bias=bias)
+
+    @property
+    def density(self):
+        n_blocks = (self.out_features // self.block[0]) * (self.in_features // self.block[1])
+        return self.blocks.size(0) / n_blocks
+
+    def to_dense(self):
+        n_rows, n_cols = self.out_features // self.block[0], self.in_features // self.block[1]
+        tiles = self.blocks.new(n_rows, n_cols, *self.block).zero_()
+        if self.blocks.size(0) > 0:
+            tiles[self.block_rows, self.block_cols] = self.blocks
+        return tiles.permute(0, 2, 1, 3).contiguous().view(self.out_features, self.in_features)
+
+    def panels(self):
+        key = tuple((t.data_ptr(), t._version, t.device) for t in (self.blocks, self.block_rows, self.block_cols))
+        if self._panels is not None and key == self._panels_key:
+            return self._panels
+        n_rows = self.out_features // self.block[0]
+        rows = self.block_rows.cpu()
+        counts = torch.zeros(n_rows).long()
+        if rows.numel() > 0:
+            counts.index_add_(0, rows, torch.ones(rows.numel()).long())
+        width = max(int(counts.max()), 1)
+        starts = counts.cumsum(0) - counts
+        slots = torch.arange(0, rows.numel()).long() - starts[rows] if rows.numel() > 0 else rows
+        panels = self.blocks.new(n_rows, width, *self.block).zero_()
+        columns = torch.zeros(n_rows, width, self.block[1]).long()
+        if rows.numel() > 0:
+            panels[rows, slots.to(rows.device)] = self.blocks.cpu().to(panels.device)
+            offsets = torch.arange(0, self.block[1]).long().view(1, -1)
+            columns[rows, slots] = self.block_cols.cpu().view(-1, 1) * self.block[1] + offsets
+        panels = panels.transpose(2, 3).contiguous().view(n_rows, width * self.block[1], self.block[0])
+        self._panels = (panels, columns.view(-1).to(self.blocks.device), width * self.block[1])
+        self._panels_key = key
+        return self._panels
+
+    def forward(self, x):
+        panels, columns, panel_width = self.panels()
+        x_2d = x.contiguous().view(-1, self.in_features)
+        batch_size = x_2d.size(0)
+        gathered = x_2d.index_select(1, columns).view(batch_size, -1, panel_width).transpose(0, 1)
+        out = gathered.bmm(panels).transpose(0, 1).contiguous().view(batch_size, self.out_features)
+        if self.bias is not None:
+            out = out + self.bias
+        return out.view(*x.size()[:-1], self.out_features)
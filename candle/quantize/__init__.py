@@ -1,3 +1,5 @@
+from .binary import *
 from .dorefa import *
+from .integer import *
 from .soft import *
 from .stochastic import *
\ No newline at end of file
@@ -0,0 +1,251 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from candle.proxy import *
+from .integer import _layer_params, _pair, _target_modules
+
+_binary_types = (nn.Linear, nn.Conv2d, ProxyLinear, ProxyConv2d)
+_M1 = 0x5555555555555555
+_M2 = 0x3333333333333333
+_M4 = 0x0F0F0F0F0F0F0F0F
+_H01 = 0x0101010101010101
+
+def _bit_weights(device):
+    # bit 63 is the sign bit of an int64 word, so its weight is -2^63
+    return torch.LongTensor([1 << i for i in range(63)] + [-(1 << 63)]).to(device)
+
+def pack_bits64(bits):
+    """
+    Packs a 0/1 tensor along its last dimension into int64 words: bit i of word j holds element
+    64 * j + i, and the last word is zero padded.
+    """
+    bits = bits.long()
+    pad = (-bits.size(-1)) % 64
+    if pad:
+        bits = torch.cat([bits, bits.new(*bits.size()[:-1], pad).zero_()], -1)
+    words = bits.view(*bits.size()[:-1], -1, 64)
+    return (words * _bit_weights(bits.device)).sum(-1)
+
+def popcount64(x, inplace=False):
+    """SWAR population count of every int64 word."""
+    if not inplace:
+        x = x.clone()
+    x -= (x >> 1) & _M1
+    x = (x & _M2) + ((x >> 2) & _M2)
+    x += x >> 4
+    x &= _M4
+    x *= _H01
+    x >>= 56
+    return x
+
+def popcount_sum(words):
+    """
+    Sum of popcount64 over the last dimension. Carry-save adders first fold every three words of a
+    weight into a sum word of that weight and a carry word of twice the weight (Harley-Seal), so only
+    the last few words of each weight are popcounted: about 5 bitwise ops per word instead of 12.
+    """
+    total = 0
+    planes = [(1, words)]
+    while planes:
+        folded = {}
+        for weight, plane in planes:
+            n = plane.size(-1)
+            if n < 3:
+                total = total + weight * popcount64(plane).sum(-1)
+                continue
+            k = n // 3
+            a, b, c = plane[..., :k], plane[..., k:2 * k], plane[..., 2 * k:3 * k]
+            partial = a ^ b
+            carry = (a & b) | (partial & c)
+            partial ^= c
+            folded.setdefault(weight, []).extend([partial] + ([plane[..., 3 * k:]] if n > 3 * k else []))
+            folded.setdefault(2 * weight, []).append(carry)
+        planes = [(weight, torch.cat(parts, -1) if len(parts) > 1 else parts[0])
+            for weight, parts in sorted(folded.items())]
+    return total
+
+def binary_matmul(x_signs, w_signs, n, x_mask=None, w_mask=None, chunk_elements=1 << 19):
+    """
+    Dot products between the rows of x and of w, given as packed sign bits (1 for +1) of length n.
+    Without masks, values are ±1 and the product is n - 2 * popcount(x XOR w). Ternary operands also
+    pass packed nonzero masks: the product is 2 * popcount(m AND NOT (x XOR w)) - popcount(m), with
+    m the common nonzero bits. Rows of x run in chunks bounding the (rows, out, words) intermediate.
+    """
+    n_rows, n_words = x_signs.size()
+    n_out = w_signs.size(0)
+    ternary = x_mask is not None or w_mask is not None
+    if ternary:
+        valid = pack_bits64(x_signs.new(n).fill_(1))
+        x_mask = valid.unsqueeze(0) if x_mask is None else x_mask
+        w_mask = valid.unsqueeze(0) if w_mask is None else w_mask
+    out = x_signs.new(n_rows, n_out)
+    chunk = max(1, chunk_elements // max(n_out * n_words, 1))
+    for start in range(0, n_rows, chunk):
+        end = min(start + chunk, n_rows)
+        diff = x_signs[start:end].unsqueeze(1) ^ w_signs.unsqueeze(0)
+        if not ternary:
+            out[start:end] = n - 2 * popcount_sum(diff)
+            continue
+        mask = x_mask[start:end].unsqueeze(1) & w_mask.unsqueeze(0) if x_mask.size(0) > 1 else \
+            (x_mask & w_mask).unsqueeze(0)
+        out[start:end] = 2 * popcount_sum(mask & ~diff) - popcount_sum(mask)
+    return out
+
+def ternarize(weight, tol=1E-4):
+    """
+    Splits a weight whose rows each take values in {-a, 0, a} into values in {-1, 0, 1} and per-row
+    scales a; raises ValueError for any other weight.
+    """
+    matrix = weight.detach().contiguous().view(weight.size(0), -1)
+    scale = matrix.abs().max(1)[0]
+    safe_scale = scale.clamp(min=1E-12).view(-1, 1)
+    values = (matrix / safe_scale).round()
+    if ((values * safe_scale - matrix).abs() > tol * safe_scale).any():
+        raise ValueError("Weight is not binary or ternary!")
+    return values.view(*weight.size()), scale
+
+def _input_kind(x, tol=1E-4):
+    magnitudes = x.detach().abs()
+    top = float(magnitudes.max())
+    nonzero = magnitudes[magnitudes > tol * top] if top > 0 else magnitudes[:0]
+    if ((nonzero - top).abs() > tol * top).any():
+        return None
+    return "binary" if nonzero.numel() == x.numel() else "ternary"
+
+class BinaryLinear(nn.Module):
+    """
+    Linear layer over bit-packed binary or ternary weights with one float scale per output. Inputs
+    are packed into sign bits (plus nonzero bits with ternary_input) on the fly and multiplied by
+    XNOR or AND plus popcount; the input scale is its largest magnitude. Weights take 1 (binary) or
+    2 (ternary) bits each.
+    """
+
+    def __init__(self, values, scale, bias=None, ternary_input=False):
+        super().__init__()
+        self.out_features, self.in_features = values.size()
+        self.ternary = bool((values == 0).any())
+        self.ternary_input = ternary_input
+        self.register_buffer("weight_signs", pack_bits64(values > 0))
+        self.register_buffer("weight_mask", pack_bits64(values != 0) if self.ternary else None)
+        self.register_buffer("scale", scale.detach().clone())
+        self.register_buffer("bias", None if bias is None else bias.detach().clone())
+
+    @classmethod
+    def from_weight(cls, weight, bias=None, ternary_input=False, tol=1E-4):
+        values, scale = ternarize(weight, tol)
+        return cls(values, scale, bias=bias, ternary_input=ternary_input)
+
+    def to_dense(self):
+        bits = (self.weight_signs.unsqueeze(-1) >> torch.arange(0, 64).long().to(self.scale.device)) & 1
+        values = 2 * bits.view(self.out_features, -1)[:, :self.in_features] - 1
+        if self.ternary:
+            mask = (self.weight_mask.unsqueeze(-1) >> torch.arange(0, 64).long().to(self.scale.device)) & 1
+            values = values * mask.view(self.out_features, -1)[:, :self.in_features]
+        return values.float() * self.scale.view(-1, 1)
+
+    def binary_matmul(self, x_2d):
+        x_scale = x_2d.abs().max()
+        x_mask = pack_bits64(x_2d != 0) if self.ternary_input else None
+        dots = binary_matmul(pack_bits64(x_2d > 0), self.weight_signs, self.in_features, x_mask, self.weight_mask)
+        out = dots.float() * (x_scale * self.scale)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+    def forward(self, x):
+        out = self.binary_matmul(x.contiguous().view(-1, self.in_features))
+        return out.view(*x.size()[:-1], self.out_features)
+
+class BinaryConv2d(BinaryLinear):
+    """
+    Conv2d over bit-packed weights. By default the weights are unpacked for a float conv, which beats
+    im2col plus popcount on CPU; with popcount, it runs as a BinaryLinear over im2col patches, where
+    zero padding makes the inputs ternary.
+    """
+
+    def __init__(self, values, scale, bias=None, ternary_input=False, stride=1, padding=0, dilation=1,
+            popcount=False):
+        self.kernel_size = tuple(values.size()[2:])
+        self.stride = _pair(stride)
+        self.padding = _pair(padding)
+        self.dilation = _pair(dilation)
+        self.popcount = popcount
+        ternary_input = ternary_input or any(p > 0 for p in self.padding)
+        super().__init__(values.contiguous().view(values.size(0), -1), scale, bias=bias, ternary_input=ternary_input)
+        self.out_channels = self.out_features
+
+    @classmethod
+    def from_weight(cls, weight, bias=None, ternary_input=False, tol=1E-4, **conv_kwargs):
+        values, scale = ternarize(weight, tol)
+        return cls(values, scale, bias=bias, ternary_input=ternary_input, **conv_kwargs)
+
+    def forward(self, x):
+        if not self.popcount:
+            weight = self.to_dense().view(self.out_channels, -1, *self.kernel_size)
+            return F.conv2d(x, weight, self.bias, self.stride, self.padding, self.dilation)
+        cols = F.unfold(x, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride)
+        rows = cols.transpose(1, 2).contiguous().view(-1, cols.size(1))
+        out = self.binary_matmul(rows).view(x.size(0), -1, self.out_channels).transpose(1, 2)
+        sizes = [(x.size(2 + i) + 2 * self.padding[i] - self.dilation[i] * (self.kernel_size[i] - 1) - 1) //
+            self.stride[i] + 1 for i in range(2)]
+        return out.contiguous().view(x.size(0), self.out_channels, *sizes)
+
+def detect_binary_inputs(model, batches, tol=1E-4):
+    """
+    Runs model in eval mode on batches and returns {module: "binary" or "ternary"} for every Linear
+    or Conv2d (or proxy) whose inputs were ±a or {-a, 0, a} on every batch.
+    """
+    kinds = {}
+    def record(module, inputs, output):
+        kind = _input_kind(inputs[0], tol)
+        previous = kinds.get(module, "binary")
+        kinds[module] = None if None in (kind, previous) else "ternary" if "ternary" in (kind, previous) else kind
+    handles = [module.register_forward_hook(record) for module in _target_modules(model, _binary_types)]
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            for batch in batches:
+                model(batch[0] if isinstance(batch, (list, tuple)) else batch)
+    finally:
+        model.train(training)
+        for handle in handles:
+            handle.remove()
+    return {module: kind for module, kind in kinds.items() if kind is not None}
+
+def export_binary(model, batches, tol=1E-4, inplace=False, popcount_convs=False):
+    """
+    Replaces every Linear and Conv2d (or proxy) whose eval-mode weights are binary or ternary per
+    output and whose inputs on batches are too by a bit-packed BinaryLinear or BinaryConv2d. Other
+    layers, such as a first layer reading real-valued data, stay as they are. Convs only run the
+    popcount kernel with popcount_convs.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    kinds = detect_binary_inputs(model, batches, tol)
+    layers = {}
+    with torch.no_grad():
+        for module, kind in kinds.items():
+            weight, bias, conv_kwargs = _layer_params(module)
+            if conv_kwargs is not None and conv_kwargs.pop("groups") > 1:
+                continue
+            try:
+                if conv_kwargs is None:
+                    layer = BinaryLinear.from_weight(weight, bias, ternary_input=kind == "ternary", tol=tol)
+                else:
+                    layer = BinaryConv2d.from_weight(weight, bias, ternary_input=kind == "ternary", tol=tol,
+                        popcount=popcount_convs, **conv_kwargs)
+            except ValueError:
+                continue
+            layers[module] = layer
+    if model in layers:
+        return layers[model]
+    for parent in list(model.modules()):
+        for name, child in parent._modules.items():
+            if child in layers:
+                parent._modules[name] = layers[child]
+    return model
@@ -0,0 +1,230 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from candle.proxy import *
+
+try:
+    from torch.ao.nn import quantized as _nnq
+except ImportError:
+    try:
+        import torch.nn.quantized as _nnq
+    except ImportError:
+        _nnq = None
+
+_integer_types = (nn.Linear, nn.Conv1d, nn.Conv2d, ProxyLinear, ProxyConv1d, ProxyConv2d)
+
+def activation_qparams(min_, max_, bits=8):
+    """Scale and zero point mapping [min_, max_] (widened to include 0) onto unsigned bits-bit integers."""
+    min_, max_ = min(min_, 0.), max(max_, 0.)
+    quant_max = (1 << bits) - 1
+    scale = (max_ - min_) / quant_max if max_ > min_ else 1.
+    zero_point = int(min(max(round(-min_ / scale), 0), quant_max))
+    return scale, zero_point
+
+def quantize_weight(weight, bits=8):
+    """Symmetric per-output-channel quantization: int8 values and one float scale per channel."""
+    quant_max = (1 << (bits - 1)) - 1
+    weight = weight.detach()
+    scales = (weight.contiguous().view(weight.size(0), -1).abs().max(1)[0] / quant_max).clamp(min=1E-8)
+    values = (weight / scales.view(-1, *[1] * (weight.dim() - 1))).round().clamp(-quant_max, quant_max)
+    return values.char(), scales
+
+def _is_quantized(x):
+    return getattr(x, "is_quantized", False)
+
+def _pair(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else (value, value)
+
+def _conv2d_kwargs(kwargs, conv1d):
+    kwargs = {name: kwargs[name] for name in ("stride", "padding", "dilation", "groups")}
+    for name in ("stride", "padding", "dilation"):
+        value = kwargs[name]
+        if conv1d:
+            value = value[0] if isinstance(value, (list, tuple)) else value
+            kwargs[name] = (0 if name == "padding" else 1, value)
+        else:
+            kwargs[name] = _pair(value)
+    return kwargs
+
+class IntegerLayer(nn.Module):
+    """
+    Inference-only Linear, Conv1d or Conv2d over int8 per-channel weights. Float inputs are quantized
+    with the calibrated input scale and zero point (quantized tensors are taken as is), products are
+    accumulated in int32 and requantized onto the calibrated output grid. The "torch" backend runs
+    PyTorch's quantized kernels; the "int" backend is a plain int32 matmul (im2col for convs) that
+    also supports activation bit-widths below 8. Conv1d runs as a Conv2d of height 1.
+    """
+
+    def __init__(self, weight, bias, input_range, output_range, conv_kwargs=None, weight_bits=8,
+            activation_bits=8, backend=None, quantized_output=False):
+        super().__init__()
+        self.conv = conv_kwargs is not None
+        self.conv1d = self.conv and weight.dim() == 3
+        if self.conv1d:
+            weight = weight.unsqueeze(2)
+        self.conv_kwargs = _conv2d_kwargs(conv_kwargs, self.conv1d) if self.conv else None
+        qweight, scales = quantize_weight(weight, weight_bits)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("weight_scale", scales)
+        self.register_buffer("bias", None if bias is None else bias.detach().clone())
+        self.activation_bits = activation_bits
+        self.input_scale, self.input_zero_point = activation_qparams(*input_range, bits=activation_bits)
+        self.output_scale, self.output_zero_point = activation_qparams(*output_range, bits=activation_bits)
+        if backend is None:
+            backend = "torch" if _nnq is not None and activation_bits == 8 else "int"
+        if backend == "torch" and (_nnq is None or activation_bits != 8):
+            raise ValueError("The torch backend needs torch quantized ops and 8-bit activations!")
+        elif backend not in ("torch", "int"):
+            raise ValueError(f"Unknown backend {backend}!")
+        self.backend = backend
+        self.quantized_output = quantized_output
+        if backend == "torch":
+            self.qmodule = self._build_qmodule()
+
+    def _build_qmodule(self):
+        weight = self.qweight.float() * self.weight_scale.view(-1, *[1] * (self.qweight.dim() - 1))
+        zero_points = torch.zeros(weight.size(0)).long()
+        qweight = torch.quantize_per_channel(weight, self.weight_scale.double(), zero_points, 0, torch.qint8)
+        if self.conv:
+            size = self.qweight.size()
+            groups = self.conv_kwargs["groups"]
+            qmodule = _nnq.Conv2d(size[1] * groups, size[0], tuple(size[2:]), bias=self.bias is not None,
+                **self.conv_kwargs)
+        else:
+            qmodule = _nnq.Linear(self.qweight.size(1), self.qweight.size(0), bias_=self.bias is not None)
+        qmodule.set_weight_bias(qweight, self.bias)
+        qmodule.scale = self.output_scale
+        qmodule.zero_point = self.output_zero_point
+        return qmodule
+
+    @property
+    def quant_max(self):
+        return (1 << self.activation_bits) - 1
+
+    def quantize_input(self, x):
+        return torch.quantize_per_tensor(x.float(), self.input_scale, self.input_zero_point, torch.quint8)
+
+    def forward(self, x):
+        if self.conv1d:
+            x = x.unsqueeze(2)
+        if self.backend == "torch":
+            out = self.qmodule(x if _is_quantized(x) else self.quantize_input(x)).contiguous()
+            if not self.quantized_output:
+                out = out.dequantize()
+        else:
+            out = self._int_forward(x)
+        return out.squeeze(2) if self.conv1d else out
+
+    def _int_forward(self, x):
+        if _is_quantized(x):
+            scale, zero_point = x.q_scale(), x.q_zero_point()
+            centered = x.int_repr().int() - zero_point
+        else:
+            scale, zero_point = self.input_scale, self.input_zero_point
+            centered = ((x / scale).round() + zero_point).clamp(0, self.quant_max).int() - zero_point
+        weight = self.qweight.int()
+        if self.conv:
+            acc = self._int_conv(centered, weight)
+            channel_shape = (1, -1, 1, 1)
+        else:
+            acc = centered.contiguous().view(-1, weight.size(1)).matmul(weight.t())
+            acc = acc.view(*x.size()[:-1], weight.size(0))
+            channel_shape = (-1,)
+        multiplier = (scale * self.weight_scale).view(*channel_shape)
+        if self.bias is not None:
+            acc = acc + (self.bias / (scale * self.weight_scale)).round().int().view(*channel_shape)
+        out = acc.float() * multiplier
+        out_q = ((out / self.output_scale).round() + self.output_zero_point).clamp(0, self.quant_max)
+        return (out_q - self.output_zero_point) * self.output_scale
+
+    def _int_conv(self, centered, weight):
+        kwargs = self.conv_kwargs
+        kernel = weight.size()[2:]
+        # int values below 2^24 are exact in float, so im2col can run on a float copy
+        cols = F.unfold(centered.float(), kernel, dilation=kwargs["dilation"], padding=kwargs["padding"],
+            stride=kwargs["stride"]).int()
+        groups = kwargs["groups"]
+        n_out = weight.size(0)
+        acc = weight.view(groups, n_out // groups, -1).matmul(cols.view(cols.size(0), groups, -1, cols.size(2)))
+        sizes = [(centered.size(2 + i) + 2 * kwargs["padding"][i] - kwargs["dilation"][i] * (kernel[i] - 1) - 1) //
+            kwargs["stride"][i] + 1 for i in range(2)]
+        return acc.view(centered.size(0), n_out, *sizes)
+
+def _target_modules(model, types=_integer_types):
+    modules = []
+    nested = set()
+    for module in model.modules():
+        if id(module) in nested:
+            continue
+        if isinstance(module, ProxyLayer):
+            nested.update(id(m) for m in module.modules() if m is not module)
+        if isinstance(module, types):
+            modules.append(module)
+    return modules
+
+def calibrate_ranges(model, batches, types=_integer_types):
+    """
+    Runs model in eval mode on batches (inputs or (input, target) tuples) and returns the min and max
+    of the input and output of every layer of types, as {module: (input_range, output_range)}.
+    """
+    ranges = {}
+    def record(module, inputs, output):
+        stats = [(float(t.min()), float(t.max())) for t in (inputs[0], output)]
+        if module in ranges:
+            stats = [(min(a[0], b[0]), max(a[1], b[1])) for a, b in zip(ranges[module], stats)]
+        ranges[module] = tuple(stats)
+    handles = [module.register_forward_hook(record) for module in _target_modules(model, types)]
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            for batch in batches:
+                model(batch[0] if isinstance(batch, (list, tuple)) else batch)
+    finally:
+        model.train(training)
+        for handle in handles:
+            handle.remove()
+    return ranges
+
+def _layer_params(module):
+    if isinstance(module, ProxyLayer):
+        weights = module.weight_provider().reify()
+        conv_kwargs = dict(module._conv_kwargs) if isinstance(module, (ProxyConv1d, ProxyConv2d)) else None
+    else:
+        weights = [module.weight] + ([] if module.bias is None else [module.bias])
+        conv_kwargs = None
+        if isinstance(module, (nn.Conv1d, nn.Conv2d)):
+            conv_kwargs = dict(stride=module.stride, padding=module.padding, dilation=module.dilation,
+                groups=module.groups)
+    return weights[0].detach(), weights[1].detach() if len(weights) > 1 else None, conv_kwargs
+
+def convert_integer(model, batches, weight_bits=8, activation_bits=8, backend=None, requantize=False,
+        inplace=False):
+    """
+    Replaces every Linear, Conv1d and Conv2d (or their proxies, with hooks such as masks and fake
+    quantizers folded into the weights) by an IntegerLayer calibrated on batches; CPU only. With
+    requantize, every layer but the last emits quantized tensors so that consecutive layers exchange
+    integers; the model's forward must then only use ops accepting quantized tensors in between.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    ranges = calibrate_ranges(model, batches)
+    layers = {}
+    targets = [module for module in _target_modules(model) if module in ranges]
+    with torch.no_grad():
+        for i, module in enumerate(targets):
+            weight, bias, conv_kwargs = _layer_params(module)
+            layers[module] = IntegerLayer(weight.cpu(), None if bias is None else bias.cpu(), *ranges[module],
+                conv_kwargs=conv_kwargs, weight_bits=weight_bits, activation_bits=activation_bits, backend=backend,
+                quantized_output=requantize and i < len(targets) - 1)
+    if model in layers:
+        return layers[model]
+    for parent in list(model.modules()):
+        for name, child in parent._modules.items():
+            if child in layers:
+                parent._modules[name] = layers[child]
+    return model
@@ -0,0 +1,45 @@
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+import candle
+
+def time_fn(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+def random_block_weight(size, block, density):
+    n_rows, n_cols = size[0] // block[0], size[1] // block[1]
+    mask = (torch.rand(n_rows, n_cols) < density).float()
+    return torch.randn(*size) * candle.expand_block_mask(mask, block)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=0)
+    args, _ = parser.parse_known_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    size = (args.size, args.size)
+    x = torch.randn(args.batch_size, args.size)
+    print(f"{'block':>8} {'density':>8} {'dense ms':>10} {'sparse ms':>10} {'speedup':>8}")
+    for block in [(4, 4), (8, 8), (16, 1), (16, 16), (32, 32)]:
+        for density in [0.5, 0.25, 0.1, 0.05]:
+            weight = random_block_weight(size, block, density)
+            sparse = candle.BlockSparseLinear.from_dense(weight, block)
+            with torch.no_grad():
+                t_dense = time_fn(lambda: F.linear(x, weight), args.repeats)
+                t_sparse = time_fn(lambda: sparse(x), args.repeats)
+            name = f"{block[0]}x{block[1]}"
+            print(f"{name:>8} {density:>8} {1000 * t_dense:>10.3f} {1000 * t_sparse:>10.3f} {t_dense / t_sparse:>8.2f}")
+
+if __name__ == "__main__":
+    main()
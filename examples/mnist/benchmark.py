@@ -0,0 +1,54 @@
+import argparse
+import io
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import candle
+from model import FCNet, PTNet
+
+def time_fn(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+def state_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return len(buffer.getvalue())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--popcount_convs", action="store_true", default=False)
+    args, _ = parser.parse_known_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    x = torch.rand(args.batch_size, 1, 28, 28) * 2 - 1
+    print(f"{'model':>8} {'binary':>7} {'float ms':>10} {'binary ms':>10} {'speedup':>8} {'float MB':>9} "
+        f"{'binary MB':>9} {'max diff':>9}")
+    for name, net_cls in [("fcnet", FCNet), ("ptnet", PTNet)]:
+        model = net_cls()
+        # a scale of 1 makes the soft step functions hard, as at the end of training
+        model.scale.data.fill_(1)
+        model.eval()
+        binary = candle.export_binary(model, [x], popcount_convs=args.popcount_convs)
+        n_binary = sum(isinstance(m, candle.BinaryLinear) for m in binary.modules())
+        with torch.no_grad():
+            diff = (model(x) - binary(x)).abs().max().item()
+            t_float = time_fn(lambda: model(x), args.repeats)
+            t_binary = time_fn(lambda: binary(x), args.repeats)
+        print(f"{name:>8} {n_binary:>7} {t_float * 1000:>10.2f} {t_binary * 1000:>10.2f} {t_float / t_binary:>8.2f} "
+            f"{state_bytes(model) / 2**20:>9.2f} {state_bytes(binary) / 2**20:>9.2f} {diff:>9.2E}")
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torchvision import datasets, transforms
 
 from torch.autograd import Variable
 from torch.optim.lr_scheduler import ExponentialLR, ReduceLROnPlateau
@@ -23,7 +22,7 @@ class FCNet(nn.Module):
                 wrap_debug(ctx.wrap(nn.Linear(in_units, out_units), scale=scale, soft=use_soft),
                     f"lin.{in_units}.{out_units}"),
                 ctx.bypass(nn.BatchNorm1d(out_units)),
-                ctx.activation("tanh", scale=scale, soft=use_soft, limit=None),
+                ctx.activation("tanh", scale=scale, soft=use_soft),
                 nn.Dropout(dropout))
 
         self.ctx = ctx = candle.StepQuantizeContext()
@@ -100,17 +99,17 @@ class PTNet(nn.Module):
         
         self.conv1 = ctx.wrap(nn.Conv2d(1, 64, 5), scale=scale, soft=use_soft, limit=args.weight_limit)
         self.bn1 = ctx.bypass(nn.BatchNorm2d(64))
-        self.a1 = ctx.activation("tanh", scale=scale, soft=use_soft, limit=args.activation_limit)
+        self.a1 = ctx.activation("tanh", scale=scale, soft=use_soft)
 
         self.conv2 = ctx.wrap(nn.Conv2d(64, 96, 5), scale=scale, soft=use_soft, limit=args.weight_limit)
         self.bn2 = ctx.bypass(nn.BatchNorm2d(96))
-        self.a2 = ctx.activation("tanh", scale=scale, soft=use_soft, limit=args.activation_limit)
+        self.a2 = ctx.activation("tanh", scale=scale, soft=use_soft)
 
         self.dropout = nn.Dropout(0.6)
         self.pool = nn.MaxPool2d(2)
         self.fc1 = ctx.wrap(nn.Linear(16 * 96, 1024), scale=scale, soft=use_soft, limit=args.weight_limit)
         self.bn4 = ctx.bypass(nn.BatchNorm1d(1024))
-        self.a4 = ctx.activation("sigmoid", scale=scale, soft=use_soft, limit=args.activation_limit)
+        self.a4 = ctx.activation("sigmoid", scale=scale, soft=use_soft)
         self.fc2 = ctx.wrap(nn.Linear(1024, 10), scale=scale, soft=use_soft, limit=args.weight_limit)
 
     def forward(self, x):
@@ -183,45 +182,10 @@ parser.add_argument('--scale-rate', type=float, default=1,
 parser.add_argument('--sgd', action='store_true', default=False,
                     help='use SGD')
 parser.add_argument('--weight-limit', type=float, default=2)
-parser.add_argument('--activation-limit', type=float, default=None)
 args, _ = parser.parse_known_args()
 args.cuda = not args.no_cuda and torch.cuda.is_available()  
 
-torch.manual_seed(args.seed)
-if args.cuda:
-    torch.cuda.manual_seed(args.seed)
-
-
-kwargs = {'num_workers': 1, 'pin_memory': True} if args.cuda else {}
-train_loader = torch.utils.data.DataLoader(
-    datasets.MNIST('../data', train=True, download=True,
-                   transform=transforms.Compose([
-                       transforms.ToTensor()
-                   ])),
-    batch_size=args.batch_size, shuffle=True, **kwargs)
-test_loader = torch.utils.data.DataLoader(
-    datasets.MNIST('../data', train=False, transform=transforms.Compose([
-                       transforms.ToTensor()
-                   ])),
-    batch_size=args.test_batch_size, shuffle=True, **kwargs)
-net_cls = nets[args.net]
-model = net_cls()
-if args.cuda:
-    model.cuda()
-
-params = model.ctx.list_model_params()
-# params = list(model.parameters())
-if args.sgd:
-    optimizer = optim.SGD(params, lr=args.lr, momentum=0.9)
-else:
-    optimizer = candle.SignSGD(params, lr=args.lr, momentum=0.9)
-# optimizer = optim.Adam(params, lr=5E-4)
-if args.restore:
-    model.load_state_dict(torch.load(args.save), strict=False)
-
-scheduler = ReduceLROnPlateau(optimizer, patience=10, factor=0.3, mode="max")
-
-def train(epoch):
+def train(epoch, model, optimizer, train_loader):
     model.train()
     criterion = nn.CrossEntropyLoss()
     for batch_idx, (data, target) in enumerate(train_loader):
@@ -242,7 +206,7 @@ def train(epoch):
                 100. * batch_idx / len(train_loader), loss.data[0], model.scale.data[0]))
     torch.save(model.state_dict(), args.save)
 
-def test():
+def test(model, scheduler, test_loader):
     model.eval()
     test_loss = 0
     correct = 0
@@ -263,7 +227,43 @@ def test():
         test_loss, correct, len(test_loader.dataset),
         100. * correct / len(test_loader.dataset)))
 
+def main():
+    from torchvision import datasets, transforms
+    torch.manual_seed(args.seed)
+    if args.cuda:
+        torch.cuda.manual_seed(args.seed)
+
+    kwargs = {'num_workers': 1, 'pin_memory': True} if args.cuda else {}
+    train_loader = torch.utils.data.DataLoader(
+        datasets.MNIST('../data', train=True, download=True,
+                       transform=transforms.Compose([
+                           transforms.ToTensor()
+                       ])),
+        batch_size=args.batch_size, shuffle=True, **kwargs)
+    test_loader = torch.utils.data.DataLoader(
+        datasets.MNIST('../data', train=False, transform=transforms.Compose([
+                           transforms.ToTensor()
+                       ])),
+        batch_size=args.test_batch_size, shuffle=True, **kwargs)
+    net_cls = nets[args.net]
+    model = net_cls()
+    if args.cuda:
+        model.cuda()
+
+    params = model.ctx.list_model_params()
+    # params = list(model.parameters())
+    if args.sgd:
+        optimizer = optim.SGD(params, lr=args.lr, momentum=0.9)
+    else:
+        optimizer = candle.SignSGD(params, lr=args.lr, momentum=0.9)
+    # optimizer = optim.Adam(params, lr=5E-4)
+    if args.restore:
+        model.load_state_dict(torch.load(args.save), strict=False)
+
+    scheduler = ReduceLROnPlateau(optimizer, patience=10, factor=0.3, mode="max")
+    for epoch in range(1, args.epochs + 1):
+        train(epoch, model, optimizer, train_loader)
+        test(model, scheduler, test_loader)
 
-for epoch in range(1, args.epochs + 1):
-    train(epoch)
-    test()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from candle.prune import *
+
+def test_fallback_matches_export():
+    torch.manual_seed(0)
+    generator = UniformTiedGenerator()
+    dropout = LinearMarkovDropout(end_prob=0.1, tied=True, tied_generator=generator, tied_root=True)
+    model = nn.Sequential(nn.Linear(6, 8), nn.ReLU(), dropout, nn.Linear(8, 3))
+    x = torch.randn(5, 6)
+    controller = LatencyBudgetController(model, x, widths=(0.5, 1), tied_generator=generator, repeats=1)
+    assert controller.widths == [0.5, 1.]
+    exported = controller.run(0.5, x)
+    del controller.models[0.5]
+    assert (controller.run(0.5, x) - exported).abs().max() < 1E-5
+    assert not generator.fixed
+
+def test_rejects_channel_counts():
+    model = nn.Sequential(nn.Linear(6, 8), LinearMarkovDropout(), nn.Linear(8, 3))
+    with pytest.raises(ValueError):
+        LatencyBudgetController(model, torch.randn(5, 6), widths=(4, 8))
@@ -0,0 +1,25 @@
+import torch
+import torch.nn as nn
+
+from candle.prune import *
+
+def _model():
+    return nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(), nn.Flatten(), nn.Linear(16, 2))
+
+def test_wrap_model_parameters_before_forward():
+    torch.manual_seed(0)
+    ctx = GroupPruneContext()
+    model = ctx.wrap_model(_model())
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    x = torch.randn(2, 3, 4, 4)
+    model(x).sum().backward()
+    optimizer.step()
+    masks = [p for proxy in ctx.list_proxies("weight_hook", WeightMaskGroup) for p in proxy.parameters()]
+    optimized = set(id(p) for group in optimizer.param_groups for p in group["params"])
+    assert masks and all(id(p) in optimized for p in masks)
+    assert set(model.state_dict()) == set(state)
+    restored = ctx.wrap_model(_model())
+    restored.load_state_dict(state)
+    model.load_state_dict(state)
+    assert (model(x) - restored(x)).abs().max() < 1E-6
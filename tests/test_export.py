@@ -0,0 +1,28 @@
+import torch
+import torch.nn as nn
+
+from candle.prune import *
+
+def _slimmable(generator, rebias=False, norm=False):
+    dropout = LinearMarkovDropout(end_prob=0.1, tied=True, tied_generator=generator, tied_root=True,
+        rebias=rebias, size=8)
+    if rebias:
+        dropout.add_mask.data.normal_()
+    before = [nn.BatchNorm1d(8), nn.ReLU()] if norm else [nn.ReLU()]
+    return nn.Sequential(nn.Linear(6, 8), *before, dropout, nn.Linear(8, 3))
+
+def test_export_slimmable_matches_generator():
+    torch.manual_seed(0)
+    x = torch.randn(5, 6)
+    for rebias in (False, True):
+        for norm in (False, True):
+            generator = UniformTiedGenerator()
+            model = _slimmable(generator, rebias, norm)
+            model(x)
+            model.eval()
+            for t in (0.3, 0.7, 1.):
+                exported = export_slimmable(model, t)
+                generator.fix(t)
+                with torch.no_grad():
+                    assert (model(x) - exported(x)).abs().max() < 1E-5
+                generator.fixed = False
@@ -0,0 +1,22 @@
+import torch
+import torch.nn as nn
+
+from candle.optim import FlatParameterBucket
+
+def _train(flat, set_to_none):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 4), nn.ReLU(), nn.Linear(4, 2))
+    params = list(model.parameters())
+    if flat:
+        params = [FlatParameterBucket(params).flat]
+    optimizer = torch.optim.SGD(params, lr=0.1, momentum=0.9)
+    for _ in range(3):
+        optimizer.zero_grad(set_to_none=set_to_none)
+        model(torch.randn(3, 4)).pow(2).sum().backward()
+        optimizer.step()
+    return list(model.parameters())
+
+def test_flat_bucket_matches_after_set_to_none():
+    for set_to_none in (False, True):
+        for expected, param in zip(_train(False, set_to_none), _train(True, set_to_none)):
+            assert (expected - param).abs().max() < 1E-6
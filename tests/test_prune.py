@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import torch
+import torch.nn as nn
+
+from candle.cost import CostModel
+from candle.prune import *
+
+def _count_draws(sampler):
+    draws = []
+    sample = sampler.sample
+    def counted():
+        draws.append(1)
+        sample()
+    sampler.sample = counted
+    return draws
+
+def test_sampler_steps_with_different_masks():
+    torch.manual_seed(0)
+    ctx = GroupPruneContext(stochastic=True)
+    first, second = ctx.wrap(nn.Linear(4, 4)), ctx.wrap(nn.Linear(4, 4))
+    draws = _count_draws(ctx.sampler)
+    optimizer = torch.optim.SGD(ctx.list_params(), lr=0.1)
+    x = torch.randn(2, 4)
+    for step, layers in enumerate(([first], [second], [first, second], [second])):
+        optimizer.zero_grad()
+        out = x
+        for layer in layers:
+            out = layer(out)
+        out.pow(2).sum().backward()
+        optimizer.step()
+        assert len(draws) == step + 1
+
+def test_sampler_accumulates_without_step():
+    ctx = GroupPruneContext(stochastic=True)
+    first, second = ctx.wrap(nn.Linear(4, 4)), ctx.wrap(nn.Linear(4, 4))
+    draws = _count_draws(ctx.sampler)
+    x = torch.randn(2, 4)
+    first(x).sum().backward()
+    second(x).sum().backward()
+    assert len(draws) == 1
+
+def test_sampler_eval_masks_follow_pruning():
+    torch.manual_seed(0)
+    ctx = GroupPruneContext(stochastic=True)
+    layer = ctx.wrap(nn.Linear(8, 8))
+    layer.eval()
+    x = torch.randn(2, 8)
+    with torch.no_grad():
+        before = layer(x)
+        ctx.prune(90)
+        after = layer(x)
+    assert (before - after).abs().max() > 0
+
+class _FixedLatencyModel(CostModel):
+    def calibrate(self, repeats=10, warmup=2):
+        for entry, seconds in zip(self.layers, (1E-3, 3E-3)):
+            entry.latency = seconds
+        return self.latency_table
+
+def test_latency_costs_per_layer():
+    ctx = GroupPruneContext(stochastic=True)
+    first, second = ctx.wrap(nn.Linear(8, 8)), ctx.wrap(nn.Linear(8, 8))
+    model = nn.Sequential(first, second)
+    costs = ctx.set_l0_costs(model, torch.randn(2, 8), latency=True, cost_model=_FixedLatencyModel(model))
+    first_mask, second_mask = [layer.find_provider(WeightMaskGroup) for layer in (first, second)]
+    assert abs(costs[second_mask] / costs[first_mask] - 3) < 1E-6
+
+def test_sensitivity_leaves_frozen_model_unchanged():
+    torch.manual_seed(0)
+    ctx = GroupPruneContext()
+    model = nn.Sequential(ctx.wrap(nn.Linear(8, 16)), nn.ReLU(), ctx.wrap(nn.Linear(16, 4)))
+    ctx.freeze()
+    x = torch.randn(16, 8)
+    batches = [(x, torch.randint(0, 4, (16,)))]
+    with torch.no_grad():
+        before = model(x)
+    SensitivityAnalysis(ctx, model, batches, levels=(50, 90)).run()
+    with torch.no_grad():
+        assert (model(x) - before).abs().max() < 1E-6
+
+def test_n_groups_per_group():
+    ctx = GroupPruneContext()
+    first, second = ctx.wrap(nn.Linear(10, 4)), ctx.wrap(nn.Linear(4, 100))
+    first_mask, second_mask = [layer.find_provider(WeightMaskGroup) for layer in (first, second)]
+    assert (first_mask.n_groups, second_mask.n_groups) == (11, 5)
+
+def test_prune_async_ranks_snapshot():
+    torch.manual_seed(0)
+    ctx = PruneContext()
+    layer = ctx.wrap(nn.Linear(8, 8), active=True)
+    mask = ctx.list_proxies("weight_hook", WeightMask)[0].masks.reify(flat=True)[0]
+    weight = layer.weight_provider.root.parameters()[0]
+    expected = weight.data.abs() > weight.data.abs().view(-1).median()
+    release = threading.Event()
+    ctx._prune_executor = ThreadPoolExecutor(max_workers=1)
+    ctx._prune_executor.submit(release.wait)
+    handle = ctx.prune_async(50)
+    weight.data.copy_(1 / weight.data)
+    release.set()
+    assert handle.commit()
+    assert torch.equal(mask.data != 0, expected)
+
+def test_frozen_caches_follow_load_state_dict():
+    torch.manual_seed(0)
+    models = []
+    for _ in range(2):
+        ctx = GroupPruneContext()
+        models.append((ctx, nn.Sequential(ctx.wrap(nn.Linear(8, 16)), nn.ReLU(), ctx.wrap(nn.Linear(16, 4)))))
+        ctx.freeze()
+    (_, model), (source_ctx, source) = models
+    source_ctx.prune(50)
+    x = torch.randn(3, 8)
+    with torch.no_grad():
+        model(x)
+        model.load_state_dict(source.state_dict())
+        assert (model(x) - source(x)).abs().max() < 1E-6